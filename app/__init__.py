@@ -17,17 +17,42 @@ def create_app(config_class=Config):
     # Ensure upload folder exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+    from app.database import engine_options, init_engine
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(app.config),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    }
+
     db.init_app(app)
     login_manager.init_app(app)
     csrf.init_app(app)
     login_manager.login_view = 'auth.login'
     login_manager.login_message = 'Please log in to access this page.'
 
-    from app.models import User
+    from app.lookups import lookups
 
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return lookups.user(int(user_id))
+
+    from app import rollups, storage, search, changes, instrumentation, money, rates, anomalies
+    from app.passwords import hasher
+    from app.cache import cache
+    from app.jobs import queue
+    from app import thumbnails
+    money.init_app(app)
+    rates.cache.init_app(app)
+    rollups.init_app(app)
+    search.init_app(app)
+    anomalies.init_app(app)
+    changes.init_app(app)
+    storage.init_app(app)
+    cache.init_app(app)
+    lookups.init_app(app)
+    hasher.init_app(app)
+    queue.init_app(app)
+    thumbnails.cache.init_app(app)
+    instrumentation.init_app(app)
 
     # Register blueprints
     from app.routes import auth, main, expenses, api
@@ -36,8 +61,12 @@ def create_app(config_class=Config):
     app.register_blueprint(expenses.bp)
     app.register_blueprint(api.bp)
 
-    # Create database tables
+    # Create database tables and bring existing ones up to date
     with app.app_context():
+        init_engine(app, db.engine)
         db.create_all()
+        from app.migrations import upgrade
+        upgrade(db.engine)
+        queue.resume()
 
     return app
@@ -0,0 +1,262 @@
+import math
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import select, func, extract, case, literal
+from app import db, money, rates
+from app.models import Expense
+
+BUCKETS = ('day', 'week', 'month', 'quarter', 'year')
+METRICS = ('sum', 'count', 'avg', 'min', 'max')
+# Date parts (year, month, day) the SQL grouping keeps for each bucket size
+GRAIN = {'year': 1, 'quarter': 2, 'month': 2, 'week': 3, 'day': 3}
+# Months spanned by the calendar buckets
+MONTHS = {'month': 1, 'quarter': 3, 'year': 12}
+# Amounts fetched per batch when reading rows for percentiles
+PERCENTILE_BATCH_SIZE = 5000
+
+expense = Expense.__table__
+
+
+def bucket_start(day, bucket):
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    if bucket == 'quarter':
+        return date(day.year, (day.month - 1) // 3 * 3 + 1, 1)
+    if bucket == 'year':
+        return date(day.year, 1, 1)
+    return day
+
+
+def shift(start, bucket, n):
+    """The bucket ``n`` buckets after (or before) the one starting at ``start``."""
+    if bucket == 'day':
+        return start + timedelta(days=n)
+    if bucket == 'week':
+        return start + timedelta(weeks=n)
+    index = start.year * 12 + start.month - 1 + n * MONTHS[bucket]
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def year_before(start, bucket):
+    """The bucket a year-over-year comparison pairs with ``start``."""
+    if bucket == 'week':
+        # 52 weeks back keeps ISO weeks on the same weekday
+        return shift(start, bucket, -52)
+    if bucket == 'day':
+        # 29 February pairs with the 28th
+        if (start.month, start.day) == (2, 29):
+            start = start.replace(day=28)
+        return start.replace(year=start.year - 1)
+    return shift(start, bucket, -12 // MONTHS[bucket])
+
+
+def data_range(start, end, bucket, window=None, compare=False):
+    """``(first, data_start, data_end)``: the first bucket of ``start`` to
+    ``end``, and the dates aggregate() reads to fill it, rolling windows and
+    comparisons included (``data_end`` exclusive).
+
+    Raises ValueError if they reach past the representable dates.
+    """
+    first, last = bucket_start(start, bucket), bucket_start(end, bucket)
+    try:
+        # Earlier buckets feed the first rolling windows and the comparisons
+        data_start = first
+        if window and window > 1:
+            data_start = shift(first, bucket, 1 - window)
+        if compare:
+            data_start = min(data_start, year_before(first, bucket))
+        data_end = shift(last, bucket, 1)
+    except (ValueError, OverflowError):
+        raise ValueError('Date range out of bounds') from None
+    return first, data_start, data_end
+
+
+def bucket_count(start, end, bucket):
+    """Number of buckets from the one holding ``start`` to the one holding ``end``."""
+    first, last = bucket_start(start, bucket), bucket_start(end, bucket)
+    if bucket in ('day', 'week'):
+        return (last - first).days // (7 if bucket == 'week' else 1) + 1
+    return ((last.year - first.year) * 12 + last.month - first.month) // MONTHS[bucket] + 1
+
+
+class _Stats:
+    __slots__ = ('total', 'count', 'low', 'high')
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+        self.low = None
+        self.high = None
+
+    def add(self, total, count, low, high):
+        self.total += total
+        self.count += count
+        self.low = low if self.low is None else min(self.low, low)
+        self.high = high if self.high is None else max(self.high, high)
+
+
+def _range_clause(start, end):
+    return (
+        expense.c.date >= datetime.combine(start, datetime.min.time()),
+        expense.c.date < datetime.combine(end, datetime.min.time()),
+    )
+
+
+def _filtered(query, user_id, start, end, category_ids):
+    query = query.where(expense.c.user_id == user_id, *_range_clause(start, end))
+    if category_ids:
+        query = query.where(expense.c.category_id.in_(category_ids))
+    return query
+
+
+def _grouped(user_id, start, end, bucket, category_ids, base):
+    """Per-(currency, category, date) sums, counts and extremes from SQL.
+
+    Rows in ``base`` are grouped as coarsely as the bucket allows; other
+    currencies keep their day, which picks the exchange rate.
+    """
+    grain = GRAIN[bucket]
+    parts = [extract('year', expense.c.date), extract('month', expense.c.date), extract('day', expense.c.date)]
+    keys = parts[:grain] + [case((expense.c.currency == base, literal(1)), else_=part) for part in parts[grain:]]
+    inner = _filtered(select(
+        expense.c.currency,
+        expense.c.category_id,
+        *[key.label(name) for key, name in zip(keys, ('year', 'month', 'day'))],
+        expense.c.amount_minor
+    ), user_id, start, end, category_ids).subquery()
+    return db.session.execute(select(
+        inner.c.currency, inner.c.category_id, inner.c.year, inner.c.month, inner.c.day,
+        func.sum(inner.c.amount_minor), func.count(), func.min(inner.c.amount_minor), func.max(inner.c.amount_minor)
+    ).group_by(inner.c.currency, inner.c.category_id, inner.c.year, inner.c.month, inner.c.day))
+
+
+def _amounts(user_id, start, end, bucket, category_ids, converter, group_of):
+    """Every amount in the range, converted, in one list per (group, bucket)."""
+    query = _filtered(select(
+        expense.c.date, expense.c.currency, expense.c.category_id, expense.c.amount_minor
+    ), user_id, start, end, category_ids)
+    amounts = defaultdict(list)
+    for day, currency, category_id, minor in db.session.execute(
+            query.execution_options(yield_per=PERCENTILE_BATCH_SIZE)):
+        value = converter.convert(minor, currency, day)
+        if value is not None:
+            amounts[(group_of(category_id), bucket_start(day.date(), bucket))].append(value)
+    return amounts
+
+
+def percentile(ordered, p):
+    """Linearly interpolated ``p``th percentile of a sorted sequence."""
+    position = (len(ordered) - 1) * p / 100
+    low = math.floor(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def aggregate(user_id, start, end, bucket='month', category_ids=(), by_category=False,
+              metrics=('sum', 'count', 'avg'), percentiles=(), window=None, compare=False, converter=None):
+    """Aggregates of the user's expenses from ``start`` to ``end`` (inclusive,
+    widened to whole buckets), one dense series per group.
+
+    SQL does the grouping; sums, counts and extremes are then merged into
+    buckets, rolling windows come from prefix sums over the dense series, and
+    percentiles are exact over the bucket's sorted amounts. Amounts are in
+    ``converter``'s base currency (default: CURRENCY).
+    """
+    from app.lookups import lookups
+    converter = converter or rates.cache.converter()
+    base = converter.base
+    first, data_start, data_end = data_range(start, end, bucket, window, compare)
+
+    def group_of(category_id):
+        return category_id if by_category else None
+
+    stats = defaultdict(_Stats)
+    for currency, category_id, year, month, day, total, count, low, high in _grouped(
+            user_id, data_start, data_end, bucket, category_ids, base):
+        day = date(int(year), int(month), int(day))
+        if currency != base:
+            total = converter.convert(total, currency, day)
+            if total is None:
+                continue
+            low, high = converter.convert(low, currency, day), converter.convert(high, currency, day)
+        stats[(group_of(category_id), bucket_start(day, bucket))].add(total, count, low, high)
+
+    amounts = {}
+    if percentiles:
+        amounts = _amounts(user_id, first, data_end, bucket, category_ids, converter, group_of)
+
+    exp = money.exponent(base)
+
+    def major(minor):
+        return None if minor is None else minor / 10 ** exp
+
+    starts = [data_start]
+    while starts[-1] < data_end:
+        starts.append(shift(starts[-1], bucket, 1))
+    starts.pop()
+    index = {day: i for i, day in enumerate(starts)}
+    offset = index[first]
+
+    names = {row.id: row.name for row in lookups.categories(user_id)}
+    groups = sorted({group for group, day in stats}, key=lambda g: (g is not None, g or 0))
+    if not by_category:
+        groups = [None]
+    series = []
+    for group in groups:
+        cells = [stats.get((group, day)) for day in starts]
+        totals = [cell.total if cell else 0 for cell in cells]
+        counts = [cell.count if cell else 0 for cell in cells]
+        running_totals = list(accumulate(totals, initial=0))
+        running_counts = list(accumulate(counts, initial=0))
+        buckets = []
+        for i in range(offset, len(starts)):
+            cell = cells[i] or _Stats()
+            entry = {'start': starts[i].isoformat(), 'end': (shift(starts[i], bucket, 1) - timedelta(days=1)).isoformat()}
+            if 'sum' in metrics:
+                entry['sum'] = major(cell.total)
+                entry['sum_minor'] = cell.total
+            if 'count' in metrics:
+                entry['count'] = cell.count
+            if 'avg' in metrics:
+                entry['avg'] = major(cell.total / cell.count) if cell.count else None
+            if 'min' in metrics:
+                entry['min'] = major(cell.low)
+            if 'max' in metrics:
+                entry['max'] = major(cell.high)
+            if percentiles:
+                ordered = sorted(amounts.get((group, starts[i]), ()))
+                for p in percentiles:
+                    entry[f'p{p:g}'] = major(percentile(ordered, p)) if ordered else None
+            if window:
+                low = max(i + 1 - window, 0)
+                total = running_totals[i + 1] - running_totals[low]
+                count = running_counts[i + 1] - running_counts[low]
+                entry['rolling_sum'] = major(total)
+                entry['rolling_avg'] = major(total / count) if count else None
+            if compare:
+                previous = index.get(year_before(starts[i], bucket))
+                previous_total = totals[previous] if previous is not None else 0
+                entry['previous'] = {
+                    'start': year_before(starts[i], bucket).isoformat(),
+                    'sum': major(previous_total),
+                    'sum_minor': previous_total,
+                    'count': counts[previous] if previous is not None else 0,
+                }
+                entry['change'] = (totals[i] - previous_total) / previous_total if previous_total else None
+            buckets.append(entry)
+        item = {'buckets': buckets}
+        if by_category:
+            item = {'category_id': group, 'category': names.get(group, 'Uncategorized'), **item}
+        series.append(item)
+
+    return {
+        'bucket': bucket,
+        'start': first.isoformat(),
+        'end': (data_end - timedelta(days=1)).isoformat(),
+        'currency': base,
+        'unconverted': sorted(converter.missing),
+        'series': series,
+    }
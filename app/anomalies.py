@@ -0,0 +1,215 @@
+import math
+import re
+import unicodedata
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import event, select, update, bindparam, func, and_, or_
+from sqlalchemy.orm import Session
+from app import money
+from app.models import Expense
+
+# Amounts per IN (...) list when looking for duplicates
+CHUNK_SIZE = 500
+
+expense = Expense.__table__
+
+
+def normalize_title(title):
+    """Casefolded title words without accents or punctuation. Words holding
+    digits are dropped, since card feeds append reference numbers."""
+    value = unicodedata.normalize('NFKD', title or '')
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    return ' '.join(w for w in re.findall(r'\w+', value.lower()) if not any(c.isdigit() for c in w))
+
+
+class RunningStats:
+    """Welford's running mean and variance, with removal for edits and
+    deletes."""
+
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        if self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        delta = value - self.mean
+        self.count -= 1
+        self.mean -= delta / self.count
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+
+    def zscore(self, value):
+        if self.count < 2 or self.m2 <= 0:
+            return None
+        return (value - self.mean) / math.sqrt(self.m2 / (self.count - 1))
+
+
+class Detector:
+    """Flags likely duplicates and unusually large amounts as expenses are
+    created.
+
+    Each check reads, on the caller's connection, only the user's expenses
+    with a matching amount within DUPLICATE_WINDOW_DAYS of the new ones and
+    the amount statistics of their categories, so it sees the caller's own
+    uncommitted writes and holds nothing between checks.
+    """
+
+    def __init__(self):
+        self.window = 3
+        self.threshold = 3.0
+        self.min_samples = 20
+
+    def configure(self, app):
+        self.window = app.config['DUPLICATE_WINDOW_DAYS']
+        self.threshold = app.config['OUTLIER_ZSCORE']
+        self.min_samples = app.config['OUTLIER_MIN_SAMPLES']
+
+    def _candidates(self, connection, user_id, rows, exclude):
+        """Earlier expenses that may duplicate ``rows``, keyed like
+        ``(amount_minor, currency, title, ordinal)``."""
+        ordinals = [row['date'].toordinal() for row in rows]
+        amounts = sorted({row['amount_minor'] for row in rows})
+        slots = defaultdict(set)
+        for chunk in range(0, len(amounts), CHUNK_SIZE):
+            # Served by ix_expense_user_date; the amounts narrow the range
+            # to a handful of rows
+            for id, amount_minor, currency, title, day in connection.execute(select(
+                expense.c.id, expense.c.amount_minor, expense.c.currency, expense.c.title, expense.c.date
+            ).where(
+                expense.c.user_id == user_id,
+                expense.c.date >= datetime.fromordinal(min(ordinals) - self.window),
+                expense.c.date < datetime.fromordinal(max(ordinals) + self.window + 1),
+                expense.c.amount_minor.in_(amounts[chunk:chunk + CHUNK_SIZE]),
+            )):
+                if id not in exclude:
+                    slots[(amount_minor, currency, normalize_title(title), day.toordinal())].add(id)
+        return slots
+
+    def _stats(self, connection, user_id, rows):
+        """RunningStats of the user's amounts per (category_id, currency)
+        among those of ``rows``."""
+        keys = {(row['category_id'], row['currency']) for row in rows}
+        category_ids = {category_id for category_id, currency in keys}
+        scope = [
+            expense.c.user_id == user_id,
+            expense.c.currency.in_({currency for category_id, currency in keys}),
+            or_(
+                expense.c.category_id.in_(category_ids - {None}),
+                *([expense.c.category_id.is_(None)] if None in category_ids else [])
+            ),
+        ]
+        means = select(
+            expense.c.category_id, expense.c.currency,
+            func.count().label('count'), func.avg(expense.c.amount_minor).label('mean')
+        ).where(*scope).group_by(expense.c.category_id, expense.c.currency).subquery()
+        # Squared deviations from the mean, which stay accurate where a sum
+        # of squares would cancel out
+        deviation = expense.c.amount_minor - means.c.mean
+        found = {}
+        for category_id, currency, count, mean, m2 in connection.execute(select(
+            means.c.category_id, means.c.currency, means.c.count, means.c.mean,
+            func.sum(deviation * deviation)
+        ).select_from(expense.join(means, and_(
+            expense.c.category_id.is_not_distinct_from(means.c.category_id),
+            expense.c.currency == means.c.currency,
+        ))).where(*scope).group_by(means.c.category_id, means.c.currency, means.c.count, means.c.mean)):
+            stats = found[(category_id, currency)] = RunningStats()
+            stats.count, stats.mean, stats.m2 = count, float(mean), float(m2 or 0)
+        return found
+
+    def screen(self, connection, user_id, rows):
+        """Set ``duplicate_of_id`` and ``outlier_score`` on new expense rows
+        (mappings with title, amount_minor, currency, date and category_id,
+        and ``id`` if already inserted through ``connection``).
+
+        Rows are checked against the user's other expenses and the ones
+        before them in the list.
+        """
+        checks = [dict(
+            row, currency=row.get('currency') or money.default_currency(),
+            date=row.get('date') or datetime.utcnow(), category_id=row.get('category_id')
+        ) for row in rows]
+        # Inserted rows are taken out of what the database holds and put
+        # back one at a time, as if each had been checked before the next
+        batch = {row['id'] for row in checks if row.get('id') is not None}
+        slots = self._candidates(connection, user_id, checks, batch)
+        stats = self._stats(connection, user_id, checks)
+        for row in checks:
+            if row.get('id') is not None:
+                stats.get((row['category_id'], row['currency']), RunningStats()).remove(row['amount_minor'])
+
+        for row, check in zip(rows, checks):
+            key = (check['amount_minor'], check['currency'], normalize_title(check.get('title')))
+            ordinal = check['date'].toordinal()
+            matches = [
+                id for day in range(ordinal - self.window, ordinal + self.window + 1)
+                for id in slots.get(key + (day,), ())
+            ]
+            row['duplicate_of_id'] = min(matches) if matches else None
+            category = stats.get((check['category_id'], check['currency']))
+            score = category.zscore(check['amount_minor']) \
+                if category and category.count >= self.min_samples else None
+            row['outlier_score'] = round(score, 2) if score is not None and score >= self.threshold else None
+            # Only inserted rows have an id to point later duplicates at
+            if check.get('id') is not None:
+                slots[key + (ordinal,)].add(check['id'])
+                stats.setdefault(
+                    (check['category_id'], check['currency']), RunningStats()
+                ).add(check['amount_minor'])
+
+
+detector = Detector()
+
+
+def _before_flush(session, flush_context, instances):
+    new = {}
+    for obj in session.new:
+        if isinstance(obj, Expense) and obj.user_id is not None and obj.amount_minor is not None:
+            new.setdefault(obj.user_id, []).append(obj)
+    for user_id, objs in new.items():
+        rows = [{
+            'title': obj.title, 'amount_minor': obj.amount_minor, 'currency': obj.currency,
+            'date': obj.date, 'category_id': obj.category_id,
+        } for obj in objs]
+        detector.screen(session.connection(), user_id, rows)
+        for obj, row in zip(objs, rows):
+            obj.duplicate_of_id = row['duplicate_of_id']
+            obj.outlier_score = row['outlier_score']
+
+
+def record_inserts(session, rows):
+    """Screen expense rows inserted in bulk, outside the ORM unit of work,
+    and store the flags of those that raised one.
+
+    ``rows`` are one user's mappings as passed to changes.insert_expenses,
+    with their ``id`` set.
+    """
+    if not rows:
+        return
+    detector.screen(session.connection(), rows[0]['user_id'], rows)
+    flagged = [
+        {'row_id': row['id'], 'duplicate': row['duplicate_of_id'], 'score': row['outlier_score']}
+        for row in rows if row['duplicate_of_id'] is not None or row['outlier_score'] is not None
+    ]
+    if flagged:
+        session.execute(
+            update(expense).where(expense.c.id == bindparam('row_id'))
+            .values(duplicate_of_id=bindparam('duplicate'), outlier_score=bindparam('score')),
+            flagged
+        )
+
+
+def init_app(app):
+    detector.configure(app)
+    if not event.contains(Session, 'before_flush', _before_flush):
+        event.listen(Session, 'before_flush', _before_flush)
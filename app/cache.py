@@ -0,0 +1,247 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Session.info key holding user ids whose cached results a pending
+# transaction will make stale
+PENDING_KEY = 'cache_invalidate_users'
+
+
+class LRUBackend:
+    """In-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.user_keys = {}
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def _discard(self, entry_key):
+        del self.entries[entry_key]
+        keys = self.user_keys.get(entry_key[0])
+        if keys is not None:
+            keys.discard(entry_key)
+            if not keys:
+                del self.user_keys[entry_key[0]]
+
+    def get(self, user_id, key):
+        entry_key = (user_id, key)
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._discard(entry_key)
+                self.expirations += 1
+                return None
+            self.entries.move_to_end(entry_key)
+            return value
+
+    def set(self, user_id, key, value):
+        entry_key = (user_id, key)
+        with self.lock:
+            self.entries[entry_key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(entry_key)
+            self.user_keys.setdefault(user_id, set()).add(entry_key)
+            while len(self.entries) > self.max_entries:
+                self._discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for entry_key in self.user_keys.pop(user_id, ()):
+                self.entries.pop(entry_key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class LocalSharedClient:
+    """In-process stand-in for the Redis commands SharedBackend uses."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            item = self.data.get(name)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.data[name]
+                return None
+            return value
+
+    def set(self, name, value, ex=None):
+        with self.lock:
+            self.data[name] = (time.monotonic() + ex if ex else None, value)
+
+    def incr(self, name):
+        with self.lock:
+            expires_at, value = self.data.get(name, (None, 0))
+            value = int(value) + 1
+            self.data[name] = (expires_at, value)
+            return value
+
+
+class SharedBackend:
+    """Cache shared between workers through a Redis-compatible client.
+
+    Entries live under a per-user generation number; invalidating a user
+    bumps the generation so every older entry is skipped and left to expire.
+    Values are stored as JSON, so tuples come back as lists.
+    """
+
+    def __init__(self, client, ttl=300, prefix='expense-cache'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _generation(self, user_id):
+        return int(self.client.get(f'{self.prefix}:gen:{user_id}') or 0)
+
+    def _name(self, user_id, key):
+        return f'{self.prefix}:{user_id}:{self._generation(user_id)}:{key}'
+
+    def get(self, user_id, key):
+        data = self.client.get(self._name(user_id, key))
+        return json.loads(data) if data is not None else None
+
+    def set(self, user_id, key, value):
+        self.client.set(self._name(user_id, key), json.dumps(value), ex=self.ttl)
+
+    def invalidate(self, user_id):
+        self.client.incr(f'{self.prefix}:gen:{user_id}')
+
+    def stats(self):
+        return {}
+
+
+class NullBackend:
+    def get(self, user_id, key):
+        return None
+
+    def set(self, user_id, key, value):
+        pass
+
+    def invalidate(self, user_id):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class ResultCache:
+    """Per-user cache for computed page aggregates.
+
+    Each entry is stored with the user's data version (see app.changes),
+    which lives in the database and so moves for every process. An entry
+    from before a write, whether kept by another worker or computed while
+    the write committed, is never served after it.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or NullBackend()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        backend = app.config.get('CACHE_BACKEND', 'memory')
+        ttl = app.config.get('CACHE_TTL', 300)
+        if backend == 'memory':
+            self.backend = LRUBackend(app.config.get('CACHE_MAX_ENTRIES', 1024), ttl)
+        elif backend == 'shared':
+            url = app.config.get('CACHE_URL')
+            if url:
+                import redis
+                client = redis.Redis.from_url(url)
+            else:
+                client = LocalSharedClient()
+            self.backend = SharedBackend(client, ttl)
+        elif backend == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Unknown CACHE_BACKEND {backend!r}')
+
+        if not event.contains(Session, 'after_flush', _after_flush):
+            event.listen(Session, 'after_flush', _after_flush)
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+
+    def get_or_set(self, user_id, key, compute):
+        from app.changes import data_version
+        version = data_version(user_id)
+        entry = self.backend.get(user_id, key)
+        hit = entry is not None and entry[0] == version
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit:
+            return entry[1]
+        value = compute()
+        # A write that landed during compute may not be reflected in value
+        if data_version(user_id) == version:
+            self.backend.set(user_id, key, [version, value])
+        return value
+
+    def invalidate(self, user_id):
+        self.backend.invalidate(user_id)
+        with self.lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+        stats.update(self.backend.stats())
+        return stats
+
+
+cache = ResultCache()
+
+
+def mark_stale(session, user_id):
+    """Invalidate ``user_id``'s results once the session commits; for
+    writes that bypass the ORM unit of work."""
+    session.info.setdefault(PENDING_KEY, set()).add(user_id)
+
+
+def _after_flush(session, flush_context):
+    from app.models import Expense, Category
+    pending = session.info.setdefault(PENDING_KEY, set())
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, (Expense, Category)) and obj.user_id is not None:
+            pending.add(obj.user_id)
+
+
+def _after_commit(session):
+    for user_id in session.info.pop(PENDING_KEY, ()):
+        cache.invalidate(user_id)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    # A rolled-back savepoint leaves the outer transaction's writes pending
+    if not previous_transaction.nested:
+        session.info.pop(PENDING_KEY, None)
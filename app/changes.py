@@ -0,0 +1,158 @@
+from datetime import datetime
+from sqlalchemy import event, select, insert, update, bindparam
+from sqlalchemy.orm import Session
+from app import db
+from app.models import User, Expense, Category, Attachment, Tombstone
+
+# Most changes returned by one call to feed()
+MAX_CHANGES = 1000
+
+user = User.__table__
+expense = Expense.__table__
+
+
+def next_seq(connection, user_id, count=1):
+    """Reserve ``count`` change sequence numbers for ``user_id`` and return
+    the first.
+
+    The user row stays locked until the transaction ends, so one user's
+    writes commit in sequence order and a client never skips a number that
+    is still to commit.
+    """
+    bump = update(user).where(user.c.id == user_id).values(change_seq=user.c.change_seq + count)
+    if connection.dialect.update_returning:
+        last = connection.execute(bump.returning(user.c.change_seq)).scalar_one()
+    else:
+        connection.execute(bump)
+        last = connection.execute(select(user.c.change_seq).where(user.c.id == user_id)).scalar_one()
+    return last - count + 1
+
+
+def stamp(session, user_id, rows):
+    """Give expense rows about to be inserted in bulk their change sequence."""
+    first = next_seq(session.connection(), user_id, len(rows))
+    for offset, row in enumerate(rows):
+        row['change_seq'] = first + offset
+
+
+def insert_expenses(session, user_id, rows):
+    """Bulk-insert one user's expense rows, setting each row's ``change_seq``
+    and ``id``.
+
+    The ids are read back through the (user_id, change_seq) index instead of
+    INSERT ... RETURNING: SQLite does not promise RETURNING order, so
+    SQLAlchemy falls back to one statement per row to keep it, and the ORM
+    bulk path also splits the batch wherever rows differ in which columns
+    are NULL. A plain executemany stays a handful of multi-row statements.
+    """
+    columns = set().union(*rows)
+    for row in rows:
+        for name in columns:
+            row.setdefault(name, None)
+    stamp(session, user_id, rows)
+    session.execute(insert(expense), rows)
+    ids = dict(session.execute(
+        select(expense.c.change_seq, expense.c.id).where(
+            expense.c.user_id == user_id,
+            expense.c.change_seq.between(rows[0]['change_seq'], rows[-1]['change_seq'])
+        )
+    ).all())
+    for row in rows:
+        row['id'] = ids[row['change_seq']]
+
+
+def _before_flush(session, flush_context, instances):
+    deleted_users = {obj.id for obj in session.deleted if isinstance(obj, User)}
+    changed = {}
+    tombstones = []
+    for obj in session.new:
+        if isinstance(obj, Expense):
+            changed.setdefault(obj.user_id, []).append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, Expense) and session.is_modified(obj, include_collections=False):
+            changed.setdefault(obj.user_id, []).append(obj)
+    for obj in session.deleted:
+        if isinstance(obj, Expense) and obj.user_id not in deleted_users:
+            tombstones.append(obj)
+            changed.setdefault(obj.user_id, []).append(obj)
+    # Attachments are listed in their expense, so adding or removing one
+    # is a change to it
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Attachment):
+            parent = session.get(Expense, obj.expense_id)
+            if parent is not None and parent not in session.deleted and \
+                    parent not in changed.get(parent.user_id, ()):
+                changed.setdefault(parent.user_id, []).append(parent)
+
+    # A category's name is part of every expense in it, and deleting it
+    # uncategorizes them inside the flush; stamp those rows directly
+    categories = [
+        obj for obj in session.deleted | session.dirty
+        if isinstance(obj, Category) and obj.id is not None and obj.user_id not in deleted_users
+        and (obj in session.deleted or session.is_modified(obj, include_collections=False))
+    ]
+
+    # Any category write moves the user's sequence, which doubles as the
+    # version of all their data (see app.responses)
+    category_users = {
+        obj.user_id for obj in session.new | session.dirty | session.deleted
+        if isinstance(obj, Category) and obj.user_id is not None and obj.user_id not in deleted_users
+        and (obj not in session.dirty or session.is_modified(obj, include_collections=False))
+    }
+
+    connection = session.connection() if changed or category_users else None
+    for user_id in category_users - changed.keys():
+        next_seq(connection, user_id)
+    for user_id, objs in changed.items():
+        seq = next_seq(connection, user_id, len(objs))
+        for obj in objs:
+            obj.change_seq = seq
+            seq += 1
+    for obj in tombstones:
+        session.add(Tombstone(user_id=obj.user_id, expense_id=obj.id, change_seq=obj.change_seq))
+    for category in categories:
+        ids = connection.scalars(
+            select(expense.c.id).where(expense.c.category_id == category.id).order_by(expense.c.id)
+        ).all()
+        if ids:
+            seq = next_seq(connection, category.user_id, len(ids))
+            now = datetime.utcnow()
+            connection.execute(
+                update(expense).where(expense.c.id == bindparam('expense_id')).values(
+                    change_seq=bindparam('seq'), updated_at=now
+                ),
+                [{'expense_id': id, 'seq': seq + offset} for offset, id in enumerate(ids)]
+            )
+
+
+def data_version(user_id):
+    """The user's latest change sequence; it moves on every expense or
+    category write."""
+    return db.session.execute(select(user.c.change_seq).where(user.c.id == user_id)).scalar_one()
+
+
+def feed(user_id, since=0, limit=MAX_CHANGES):
+    """Changes to ``user_id``'s expenses after sequence ``since``, oldest
+    first: ``(changes, last_seq, has_more)``.
+
+    ``changes`` mixes Expense objects and Tombstones. Both sides read the
+    ``(user_id, change_seq)`` indexes, so the cost follows the number of
+    changes rather than the size of the history.
+    """
+    expenses = Expense.query.filter(
+        Expense.user_id == user_id, Expense.change_seq > since
+    ).options(*Expense.eager_options()).order_by(Expense.change_seq).limit(limit + 1).all()
+    tombstones = Tombstone.query.filter(
+        Tombstone.user_id == user_id, Tombstone.change_seq > since
+    ).order_by(Tombstone.change_seq).limit(limit + 1).all()
+
+    changes = sorted(expenses + tombstones, key=lambda change: change.change_seq)
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    last_seq = changes[-1].change_seq if changes else since
+    return changes, last_seq, has_more
+
+
+def init_app(app):
+    if not event.contains(Session, 'before_flush', _before_flush):
+        event.listen(Session, 'before_flush', _before_flush)
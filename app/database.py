@@ -0,0 +1,58 @@
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+
+# INSERT constructs with ON CONFLICT (upsert) support, by dialect name
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """Engine/pool options for ``SQLALCHEMY_DATABASE_URI``'s backend."""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if _is_memory_sqlite(url):
+        # Flask-SQLAlchemy pins in-memory SQLite to a single static connection
+        return {}
+    if url.get_backend_name() == 'sqlite':
+        # Local file: connections are cheap and never go stale, so no
+        # pre-ping or recycling; just enough of them for the web workers
+        return {
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+        }
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_pre_ping': True,
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    }
+
+
+def _sqlite_pragmas(config, memory):
+    pragmas = [
+        ('synchronous', config['SQLITE_SYNCHRONOUS'].upper()),
+        ('cache_size', int(config['SQLITE_CACHE_SIZE'])),
+        ('busy_timeout', int(config['SQLITE_BUSY_TIMEOUT'])),
+    ]
+    if not memory:
+        # WAL lets readers proceed while a writer commits; it (and mmap)
+        # only applies to databases backed by a file
+        pragmas.insert(0, ('journal_mode', config['SQLITE_JOURNAL_MODE'].upper()))
+        pragmas.append(('mmap_size', int(config['SQLITE_MMAP_SIZE'])))
+    return pragmas
+
+
+def init_engine(app, engine):
+    if engine.url.get_backend_name() != 'sqlite':
+        return
+    pragmas = _sqlite_pragmas(app.config, _is_memory_sqlite(engine.url))
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
@@ -0,0 +1,200 @@
+import csv
+import json
+from itertools import islice
+from sqlalchemy import func, select
+from app import money, rates
+from app.models import Expense, Category, Attachment
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for the columnar formats
+    pa = pq = None
+
+# Rows fetched from the database cursor, and written per response chunk, at a time
+BATCH_SIZE = 500
+# Columnar formats compress better with larger record batches / row groups
+COLUMNAR_BATCH_SIZE = 10000
+
+COLUMNAR_FORMATS = {
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+# Formats the background export job can write to an artifact
+EXPORT_JOB_FORMATS = {'csv', 'json', 'ndjson'} | (set(COLUMNAR_FORMATS) if pa is not None else set())
+
+CSV_HEADER = ['Date', 'Title', 'Amount', 'Currency', 'Category', 'Description']
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _batched(query):
+    return query.order_by(Expense.date.desc(), Expense.id.desc()).yield_per(BATCH_SIZE)
+
+
+def iter_csv(query):
+    writer = csv.writer(_Echo())
+    chunk = [writer.writerow(CSV_HEADER)]
+    for expense in _batched(query):
+        chunk.append(writer.writerow([
+            expense.date.strftime('%Y-%m-%d'),
+            expense.title,
+            expense.amount,
+            expense.currency,
+            expense.category.name if expense.category else 'N/A',
+            expense.description or ''
+        ]))
+        if len(chunk) >= BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def iter_ndjson(query):
+    chunk = []
+    for expense in _batched(query):
+        chunk.append(json.dumps(expense.to_dict()) + '\n')
+        if len(chunk) >= BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def iter_json(query):
+    # Same document shape as the old jsonify export, written incrementally
+    # with the totals appended once the rows have been streamed. The total
+    # is summed exactly in integer minor units of the base currency; other
+    # currencies are converted on the way.
+    converter = rates.cache.converter()
+    total_minor = 0
+    count = 0
+    chunk = ['{"expenses": [']
+    for expense in _batched(query):
+        if count:
+            chunk.append(', ')
+        chunk.append(json.dumps(expense.to_dict()))
+        minor = converter.convert(expense.amount_minor, expense.currency, expense.date)
+        if minor is not None:
+            total_minor += minor
+        count += 1
+        if len(chunk) >= BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    currency = converter.base
+    chunk.append(f'], "total_amount": {json.dumps(float(money.to_major(total_minor, currency)))}, '
+                 f'"total_minor": {total_minor}, "currency": "{currency}", '
+                 f'"unconverted": {json.dumps(sorted(converter.missing))}, "count": {count}}}')
+    yield ''.join(chunk)
+
+
+def columnar_available():
+    return pa is not None
+
+
+def _columnar_schema():
+    return pa.schema([
+        ('id', pa.int64()),
+        ('date', pa.timestamp('us')),
+        ('title', pa.string()),
+        ('amount', pa.float64()),
+        ('amount_minor', pa.int64()),
+        ('currency', pa.dictionary(pa.int32(), pa.string())),
+        ('category_id', pa.int64()),
+        ('category', pa.dictionary(pa.int32(), pa.string())),
+        ('description', pa.string()),
+        ('attachment_count', pa.int32()),
+        ('created_at', pa.timestamp('us')),
+        ('updated_at', pa.timestamp('us')),
+    ])
+
+
+def _columnar_batches(query, schema):
+    # Select plain columns rather than ORM objects; the attachment count is a
+    # correlated subquery served by the attachment.expense_id index.
+    attachment_count = select(func.count(Attachment.id)).where(
+        Attachment.expense_id == Expense.id
+    ).correlate(Expense).scalar_subquery()
+    rows = query.outerjoin(Category, Expense.category_id == Category.id).with_entities(
+        Expense.id,
+        Expense.date,
+        Expense.title,
+        Expense.amount_minor,
+        Expense.currency,
+        Expense.category_id,
+        Category.name,
+        Expense.description,
+        attachment_count,
+        Expense.created_at,
+        Expense.updated_at
+    ).order_by(Expense.date.desc(), Expense.id.desc()).yield_per(COLUMNAR_BATCH_SIZE)
+
+    rows = iter(rows)
+    while True:
+        partition = list(islice(rows, COLUMNAR_BATCH_SIZE))
+        if not partition:
+            break
+        columns = list(zip(*partition))
+        # Major units are derived for convenience; amount_minor is exact
+        columns.insert(3, [minor / 10 ** money.exponent(code) for minor, code in zip(columns[3], columns[4])])
+        yield pa.record_batch(
+            [pa.array(column, type=field.type) if not pa.types.is_dictionary(field.type)
+             else pa.array(column, type=pa.string()).dictionary_encode()
+             for column, field in zip(columns, schema)],
+            schema=schema
+        )
+
+
+class _ChunkSink:
+    # Write-only file object that hands back whatever pyarrow wrote since
+    # the last drain, so output can be yielded as it is produced.
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_arrow(query):
+    schema = _columnar_schema()
+    sink = _ChunkSink()
+    options = pa.ipc.IpcWriteOptions(compression='zstd')
+    with pa.ipc.new_stream(sink, schema, options=options) as writer:
+        for batch in _columnar_batches(query, schema):
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_parquet(query):
+    schema = _columnar_schema()
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for batch in _columnar_batches(query, schema):
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
@@ -1,8 +1,10 @@
+from decimal import Decimal
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileAllowed
-from wtforms import StringField, PasswordField, BooleanField, SubmitField, FloatField, TextAreaField, DateField, SelectField
+from flask_wtf.file import FileField, FileAllowed, FileRequired
+from wtforms import StringField, PasswordField, BooleanField, SubmitField, DecimalField, TextAreaField, DateField, SelectField
 from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Length, NumberRange
 from app.models import User
+from app import money
 
 
 class LoginForm(FlaskForm):
@@ -43,7 +45,8 @@ class ResetPasswordForm(FlaskForm):
 
 class ExpenseForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired(), Length(max=128)])
-    amount = FloatField('Amount', validators=[DataRequired(), NumberRange(min=0.01)])
+    amount = DecimalField('Amount', places=None, validators=[DataRequired(), NumberRange(min=Decimal('0.01'))])
+    currency = StringField('Currency', default=money.default_currency, validators=[DataRequired(), Length(min=3, max=3)])
     date = DateField('Date', validators=[DataRequired()])
     category_id = SelectField('Category', coerce=int, validators=[])
     description = TextAreaField('Description', validators=[Length(max=500)])
@@ -53,6 +56,20 @@ class ExpenseForm(FlaskForm):
     ])
     submit = SubmitField('Save Expense')
 
+    def validate_currency(self, currency):
+        try:
+            currency.data = money.normalize_currency(currency.data)
+        except ValueError:
+            raise ValidationError('Please use a three-letter currency code.')
+
+
+class ImportForm(FlaskForm):
+    file = FileField('Statement File', validators=[
+        FileRequired(),
+        FileAllowed(['csv', 'ofx', 'qfx'], 'Only CSV and OFX/QFX files allowed!')
+    ])
+    submit = SubmitField('Import')
+
 
 class CategoryForm(FlaskForm):
     name = StringField('Category Name', validators=[DataRequired(), Length(max=64)])
@@ -0,0 +1,191 @@
+import csv
+import html
+import io
+import re
+from datetime import datetime
+from app import db, rollups, search, changes, money, anomalies
+from app.cache import mark_stale
+from app.models import Category
+
+# Rows parsed, inserted and committed together; memory is bounded by this
+CHUNK_SIZE = 1000
+# Row errors kept for the report; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+# Size of each read from the uploaded OFX file
+OFX_READ_SIZE = 64 * 1024
+# Longer titles (bank payee names, free-form CSV) are cut to the column size
+MAX_TITLE_LENGTH = 128
+
+FORMATS = {'csv', 'ofx'}
+EXTENSIONS = {'csv': 'csv', 'ofx': 'ofx', 'qfx': 'ofx'}
+
+_OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9_.]+)>([^<]*)')
+
+
+def detect_format(filename):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return EXTENSIONS.get(ext)
+
+
+def _parse_amount(value):
+    return money.parse_amount(str(value).strip().replace('$', '').replace(',', ''))
+
+
+def _parse_date(value):
+    # Accepts the export's YYYY-MM-DD as well as full ISO timestamps
+    return datetime.fromisoformat(value.strip())
+
+
+def iter_csv_records(stream):
+    # Same columns expenses.export() writes
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        try:
+            category = (row.get('Category') or '').strip()
+            currency = (row.get('Currency') or '').strip()
+            yield reader.line_num, {
+                'title': (row.get('Title') or '').strip(),
+                'amount': _parse_amount(row.get('Amount') or ''),
+                'date': _parse_date(row.get('Date') or ''),
+                'description': row.get('Description') or None,
+                'category': category if category and category != 'N/A' else None,
+                'currency': money.normalize_currency(currency) if currency else None,
+            }
+        except ValueError as e:
+            yield reader.line_num, e
+
+
+def _ofx_date(value):
+    # YYYYMMDD[HHMMSS[.XXX]][[offset:TZ]]; the time zone is dropped
+    digits = value.strip()[:14]
+    return datetime.strptime(digits, '%Y%m%d%H%M%S' if len(digits) == 14 else '%Y%m%d')
+
+
+def _ofx_record(fields, currency):
+    amount = _parse_amount(fields.get('TRNAMT', ''))
+    if amount >= 0:
+        # Credits (refunds, deposits) are not expenses
+        return None
+    name = fields.get('NAME') or fields.get('PAYEE') or fields.get('MEMO') or ''
+    return {
+        'title': name.strip(),
+        'amount': -amount,
+        'date': _ofx_date(fields.get('DTPOSTED', '')),
+        'description': fields.get('MEMO') or None,
+        'category': None,
+        'currency': currency,
+    }
+
+
+def iter_ofx_records(stream):
+    # Tokenizes tags as the file is read, so both SGML (OFX 1.x, unclosed
+    # leaf tags) and XML (OFX 2.x) statements parse without loading it all.
+    buffer = ''
+    fields = None
+    # The statement's CURDEF precedes its transactions
+    currency = None
+    number = 0
+    decoder = io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+    while True:
+        chunk = decoder.read(OFX_READ_SIZE)
+        buffer += chunk
+        # Keep a possibly incomplete trailing tag for the next read
+        cut = max(buffer.rfind('<'), 0) if chunk else len(buffer)
+        complete, buffer = buffer[:cut], buffer[cut:]
+        for closing, tag, value in _OFX_TAG.findall(complete):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if closing and fields is not None:
+                    number += 1
+                    try:
+                        record = _ofx_record(fields, currency)
+                    except ValueError as e:
+                        record = e
+                    if record is not None:
+                        yield number, record
+                    fields = None
+                elif not closing:
+                    fields = {}
+            elif fields is not None and not closing and value.strip():
+                fields[tag] = html.unescape(value.strip())
+            elif tag == 'CURDEF' and not closing:
+                try:
+                    currency = money.normalize_currency(value)
+                except ValueError:
+                    currency = None
+        if not chunk:
+            break
+
+
+def _to_row(record, user_id, category_ids):
+    # Every format's records are checked here, like the expense form does
+    record['title'] = record['title'][:MAX_TITLE_LENGTH]
+    if not record['title']:
+        raise ValueError('Missing title')
+    name = record.pop('category')
+    if name is not None and name not in category_ids:
+        category = Category(name=name[:64], user_id=user_id)
+        db.session.add(category)
+        db.session.flush()
+        category_ids[name] = category.id
+    record['category_id'] = category_ids.get(name) if name is not None else None
+    record['user_id'] = user_id
+    record['currency'] = record.get('currency') or money.default_currency()
+    record['amount_minor'] = money.to_minor(record.pop('amount'), record['currency'])
+    if record['amount_minor'] <= 0:
+        raise ValueError('Amount must be positive')
+    return record
+
+
+def _insert_chunk(user_id, rows):
+    changes.insert_expenses(db.session, user_id, rows)
+    rollups.record_inserts(db.session, rows)
+    search.record_inserts(db.session, rows)
+    anomalies.record_inserts(db.session, rows)
+    mark_stale(db.session, user_id)
+    db.session.commit()
+    return sum(1 for row in rows if row['duplicate_of_id'] is not None)
+
+
+def import_expenses(user_id, records, chunk_size=CHUNK_SIZE):
+    """Insert parsed ``(line, record)`` pairs in chunks, yielding progress.
+
+    Each chunk is committed on its own, so a failure part way through keeps
+    the chunks already reported. The last progress dict has ``done`` set.
+    """
+    category_ids = {
+        name: id for name, id in
+        db.session.query(Category.name, Category.id).filter_by(user_id=user_id)
+    }
+    progress = {'processed': 0, 'imported': 0, 'skipped': 0, 'duplicates': 0, 'errors': [], 'done': False}
+    rows = []
+    for line, record in records:
+        progress['processed'] += 1
+        try:
+            if isinstance(record, Exception):
+                raise record
+            rows.append(_to_row(record, user_id, category_ids))
+        except ValueError as e:
+            progress['skipped'] += 1
+            if len(progress['errors']) < MAX_REPORTED_ERRORS:
+                progress['errors'].append({'line': line, 'error': str(e)})
+        if len(rows) >= chunk_size:
+            progress['duplicates'] += _insert_chunk(user_id, rows)
+            progress['imported'] += len(rows)
+            rows = []
+            yield dict(progress)
+    if rows:
+        progress['duplicates'] += _insert_chunk(user_id, rows)
+        progress['imported'] += len(rows)
+    else:
+        db.session.commit()
+    progress['done'] = True
+    yield dict(progress)
+
+
+def parse(format, stream):
+    if format == 'csv':
+        return iter_csv_records(stream)
+    if format == 'ofx':
+        return iter_ofx_records(stream)
+    raise ValueError(f'Unsupported import format {format!r}')
@@ -0,0 +1,184 @@
+import cProfile
+import hmac
+import os
+import random
+import threading
+import time
+from collections import Counter
+from flask import g, request, current_app, has_request_context, Response, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Execution context attribute holding a statement's start time; it goes
+# away with the context, including when the statement raises
+START_ATTR = 'instrumentation_query_start'
+
+
+class Metrics:
+    """Per-process counters and histograms, rendered in the Prometheus text
+    format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.buckets = Counter()
+        self.durations = Counter()
+        self.counts = Counter()
+        self.sql_queries = Counter()
+        self.sql_seconds = Counter()
+        self.slow_queries = Counter()
+
+    def observe(self, endpoint, method, status, seconds, queries, sql_seconds, slow):
+        with self.lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.counts[endpoint] += 1
+            self.durations[endpoint] += seconds
+            for bound in DURATION_BUCKETS:
+                if seconds <= bound:
+                    self.buckets[(endpoint, bound)] += 1
+            self.sql_queries[endpoint] += queries
+            self.sql_seconds[endpoint] += sql_seconds
+            self.slow_queries[endpoint] += slow
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append('# HELP http_requests_total Requests handled, by endpoint, method and status.')
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, method, status), value in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {value}')
+
+            lines.append('# HELP http_request_duration_seconds Time until the response was returned.')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for endpoint in sorted(self.counts):
+                for bound in DURATION_BUCKETS:
+                    lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} '
+                                 f'{self.buckets[(endpoint, bound)]}')
+                lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {self.counts[endpoint]}')
+                lines.append(f'http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {self.durations[endpoint]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{endpoint="{endpoint}"}} {self.counts[endpoint]}')
+
+            for name, help, values, fmt in (
+                ('sql_queries_total', 'SQL statements executed while handling requests.', self.sql_queries, '{}'),
+                ('sql_seconds_total', 'Time spent in SQL statements while handling requests.', self.sql_seconds, '{:.6f}'),
+                ('sql_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.', self.slow_queries, '{}'),
+            ):
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} counter')
+                for endpoint, value in sorted(values.items()):
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {fmt.format(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context() and 'instrumentation' in g:
+        setattr(context, START_ATTR, time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, START_ATTR, None)
+    if start is None or not has_request_context() or 'instrumentation' not in g:
+        return
+    elapsed = time.perf_counter() - start
+    stats = g.instrumentation
+    stats['queries'] += 1
+    stats['sql_seconds'] += elapsed
+    stats['statements'][statement] += 1
+    if elapsed * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        stats['slow'] += 1
+        current_app.logger.warning(
+            'Slow query (%.1f ms) in %s: %s', elapsed * 1000, request.endpoint, statement
+        )
+
+
+def _before_request():
+    g.instrumentation = {
+        'start': time.perf_counter(),
+        'queries': 0,
+        'sql_seconds': 0.0,
+        'slow': 0,
+        'statements': Counter(),
+        'profiler': None,
+    }
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return
+        g.instrumentation['profiler'] = profiler
+
+
+def _write_profile(profiler):
+    folder = current_app.config['PROFILE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'{time.time_ns()}-{request.endpoint}-{os.getpid()}.prof')
+    profiler.dump_stats(path)
+    return path
+
+
+def _after_request(response):
+    stats = g.pop('instrumentation', None)
+    if stats is None:
+        return response
+    seconds = time.perf_counter() - stats['start']
+
+    if stats['profiler'] is not None:
+        stats['profiler'].disable()
+        current_app.logger.info('Profiled %s to %s', request.endpoint, _write_profile(stats['profiler']))
+
+    # The same statement run many times in one request is the usual N+1 shape
+    statement, repeats = max(stats['statements'].items(), key=lambda item: item[1], default=(None, 0))
+    if repeats >= current_app.config['N_PLUS_ONE_THRESHOLD']:
+        current_app.logger.warning(
+            'Possible N+1 in %s: statement ran %d times: %s', request.endpoint, repeats, statement
+        )
+
+    endpoint = request.endpoint or 'unmatched'
+    metrics.observe(
+        endpoint, request.method, response.status_code, seconds,
+        stats['queries'], stats['sql_seconds'], stats['slow']
+    )
+    # Streamed bodies are still being generated, so this covers the work up
+    # to the first byte
+    response.headers.add('Server-Timing', f'app;dur={seconds * 1000:.1f}')
+    response.headers.add(
+        'Server-Timing', f'db;dur={stats["sql_seconds"] * 1000:.1f};desc="{stats["queries"]} queries"'
+    )
+    return response
+
+
+def require_metrics_token():
+    """Abort unless the request carries METRICS_TOKEN as a bearer token.
+    Without a token configured, operational endpoints exist only in debug."""
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        if not current_app.debug:
+            abort(404)
+        return
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+
+
+def metrics_view():
+    require_metrics_token()
+    from app.passwords import hasher
+    return Response(metrics.render() + hasher.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    if not app.config['INSTRUMENTATION']:
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
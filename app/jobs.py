@@ -0,0 +1,256 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import event, update, delete, func
+from sqlalchemy.orm import Session
+from app import db, thumbnails
+from app.database import _is_memory_sqlite
+from app.models import Job, Expense, Attachment
+
+# Session.info key for job ids to hand to the workers once committed
+PENDING_KEY = 'jobs_submit'
+# Seconds between sweeps for jobs past JOBS_RETENTION
+PURGE_INTERVAL = 3600
+
+HANDLERS = {}
+
+
+def handler(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+class JobQueue:
+    """Runs persisted Jobs on a thread pool outside the request thread."""
+
+    def __init__(self):
+        self.app = None
+        self.executor = None
+        self.running = set()
+        self.lock = threading.Lock()
+        self.stopping = None
+
+    def init_app(self, app):
+        self.app = app
+        workers = app.config.get('JOBS_WORKERS', 2)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs') if workers else None
+        if self.stopping is not None:
+            self.stopping.set()
+        self.stopping = threading.Event()
+        with app.app_context():
+            # In-memory SQLite has one connection and dies with the process,
+            # so there is neither a safe way nor a need to beat from a thread
+            if not _is_memory_sqlite(db.engine.url):
+                threading.Thread(
+                    target=self._heartbeat, args=(app, self.stopping), name='jobs-heartbeat', daemon=True
+                ).start()
+
+        if not event.contains(Session, 'after_commit', _after_commit):
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+
+    def _heartbeat(self, app, stopping):
+        last_purge = 0
+        while not stopping.wait(app.config['JOBS_HEARTBEAT_INTERVAL']):
+            with self.lock:
+                running = list(self.running)
+            try:
+                with app.app_context():
+                    if running:
+                        with db.engine.begin() as connection:
+                            connection.execute(update(Job).where(
+                                Job.id.in_(running), Job.status == 'running'
+                            ).values(heartbeat_at=datetime.utcnow()))
+                    if time.monotonic() - last_purge >= PURGE_INTERVAL:
+                        last_purge = time.monotonic()
+                        self.purge_expired()
+            except Exception:
+                app.logger.exception('Job heartbeat failed')
+
+    def resume(self):
+        """Resubmit jobs left queued, or running without a heartbeat, by a
+        previous process, and delete expired ones."""
+        stale = datetime.utcnow() - timedelta(seconds=self.app.config['JOBS_STALE_AFTER'])
+        db.session.execute(update(Job).where(
+            Job.status == 'running', func.coalesce(Job.heartbeat_at, Job.started_at) < stale
+        ).values(status='queued'))
+        db.session.commit()
+        self.purge_expired()
+        for (job_id,) in db.session.query(Job.id).filter_by(status='queued').order_by(Job.created_at):
+            self.submit(job_id)
+
+    def purge_expired(self):
+        """Delete finished jobs older than JOBS_RETENTION and their export
+        files; returns how many were deleted."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['JOBS_RETENTION'])
+        expired = db.session.query(Job.id, Job.artifact_path).filter(
+            Job.status.in_(('succeeded', 'failed')), Job.created_at < cutoff
+        ).all()
+        for job_id, path in expired:
+            if path and os.path.exists(path):
+                os.remove(path)
+        if expired:
+            db.session.execute(delete(Job).where(Job.id.in_([job_id for job_id, path in expired])))
+        db.session.commit()
+        return len(expired)
+
+    def submit(self, job_id):
+        if self.executor is None:
+            self.run(job_id)
+        else:
+            self.executor.submit(self.run, job_id)
+
+    def run(self, job_id):
+        with self.app.app_context():
+            # Claim atomically so two processes resuming the same table
+            # never run a job twice
+            now = datetime.utcnow()
+            claimed = db.session.execute(update(Job).where(
+                Job.id == job_id, Job.status == 'queued'
+            ).values(
+                status='running', started_at=now, heartbeat_at=now, attempts=Job.attempts + 1
+            )).rowcount
+            db.session.commit()
+            if not claimed:
+                return
+
+            with self.lock:
+                self.running.add(job_id)
+            try:
+                job = db.session.get(Job, job_id)
+                try:
+                    result = HANDLERS[job.kind](job, json.loads(job.payload or '{}'))
+                    job.status = 'succeeded'
+                    job.result = json.dumps(result) if result is not None else None
+                except Exception as e:
+                    self.app.logger.exception('Job %s (%s) failed', job_id, job.kind)
+                    db.session.rollback()
+                    job = db.session.get(Job, job_id)
+                    job.status = 'failed'
+                    job.error = str(e)
+                job.finished_at = datetime.utcnow()
+                db.session.commit()
+            finally:
+                with self.lock:
+                    self.running.discard(job_id)
+
+
+queue = JobQueue()
+
+
+def enqueue(kind, payload, user_id=None):
+    """Add a job to the current transaction; it starts once that commits."""
+    job = Job(kind=kind, payload=json.dumps(payload), user_id=user_id, status='queued')
+    db.session.add(job)
+    db.session.flush()
+    db.session.info.setdefault(PENDING_KEY, []).append(job.id)
+    return job
+
+
+def _after_commit(session):
+    for job_id in session.info.pop(PENDING_KEY, ()):
+        queue.submit(job_id)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(PENDING_KEY, None)
+
+
+@handler('attach_upload')
+def attach_upload(job, payload):
+    from app import storage
+    tmp_path = payload['tmp_path']
+    expense = db.session.get(Expense, payload['expense_id'])
+    if expense is None:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return {'attached': False, 'reason': 'expense deleted'}
+    if 'sha256' not in payload:
+        # Recorded before the staged file moves, so a retry after a crash
+        # can find it in the store
+        payload['sha256'], payload['size'] = storage.hash_staged(tmp_path)
+        job.payload = json.dumps(payload)
+        db.session.commit()
+    sha256, size = payload['sha256'], payload['size']
+    if os.path.exists(tmp_path):
+        sha256, size, path = storage.store_staged(tmp_path, payload['upload_folder'], sha256, size)
+    else:
+        path = storage.blob_path(payload['upload_folder'], sha256)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'Staged upload {tmp_path} is gone')
+    attachment = Attachment(
+        filename=payload['filename'],
+        filepath=path,
+        sha256=sha256,
+        size=size,
+        expense_id=expense.id
+    )
+    db.session.add(attachment)
+    db.session.flush()
+    thumbnails.cache.schedule(attachment)
+    return {'attached': True, 'attachment_id': attachment.id, 'sha256': sha256}
+
+
+@handler('thumbnail')
+def thumbnail(job, payload):
+    attachment = db.session.get(Attachment, payload['attachment_id'])
+    if attachment is None or not attachment.sha256:
+        return {'generated': False}
+    thumbnails.cache.generate(attachment)
+    return {'generated': True, 'sha256': attachment.sha256}
+
+
+@handler('delete_files')
+def delete_files(job, payload):
+    removed = 0
+    for path in payload['paths']:
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+    return {'removed': removed}
+
+
+@handler('export')
+def export(job, payload):
+    from app import export as exporter
+    from app.queries import filter_expenses
+
+    format = payload['format']
+    writers = {
+        'csv': (exporter.iter_csv, 'csv'),
+        'json': (exporter.iter_json, 'json'),
+        'ndjson': (exporter.iter_ndjson, 'ndjson'),
+        'arrow': (exporter.iter_arrow, 'arrow'),
+        'parquet': (exporter.iter_parquet, 'parquet'),
+    }
+    writer, extension = writers[format]
+    query = filter_expenses(
+        Expense.query.filter_by(user_id=job.user_id),
+        category_id=payload.get('category_id'),
+        start_date=payload.get('start_date'),
+        end_date=payload.get('end_date')
+    )
+    if format in ('csv', 'json', 'ndjson'):
+        query = query.options(*Expense.eager_options())
+
+    folder = payload['export_folder']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'job_{job.id}.{extension}')
+    tmp_path = path + '.part'
+    size = 0
+    with open(tmp_path, 'wb') as out:
+        for chunk in writer(query):
+            data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            out.write(data)
+            size += len(data)
+    os.replace(tmp_path, path)
+    job.artifact_path = path
+    return {'format': format, 'size': size, 'filename': f'expenses_{job.created_at:%Y%m%d}.{extension}'}
@@ -0,0 +1,106 @@
+from collections import namedtuple
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+from app import db
+from app.cache import LRUBackend
+
+# Session.info key holding user ids whose lookups a pending transaction
+# will make stale
+PENDING_KEY = 'lookup_invalidate_users'
+# g key of the lookups already made in this request
+REQUEST_KEY = 'lookups'
+
+CategoryRow = namedtuple('CategoryRow', 'id name description')
+
+
+class LookupCache:
+    """The current user and their category list, cached for the request and
+    for LOOKUP_CACHE_TTL seconds across requests in this process.
+
+    Entries are dropped when a commit writes the user or one of their
+    categories; other processes see the change once the TTL runs out.
+    """
+
+    def __init__(self):
+        self.backend = LRUBackend()
+
+    def init_app(self, app):
+        self.backend = LRUBackend(app.config['LOOKUP_CACHE_MAX_ENTRIES'], app.config['LOOKUP_CACHE_TTL'])
+        if not event.contains(Session, 'after_flush', _after_flush):
+            event.listen(Session, 'after_flush', _after_flush)
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+
+    def _get(self, user_id, key, compute):
+        local = g.setdefault(REQUEST_KEY, {})
+        if (user_id, key) in local:
+            return local[(user_id, key)]
+        value = self.backend.get(user_id, key)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.backend.set(user_id, key, value)
+        local[(user_id, key)] = value
+        return value
+
+    def user(self, user_id):
+        """The user, attached to the session without a query when cached."""
+        from app.models import User
+        values = self._get(user_id, 'user', lambda: _user_values(user_id))
+        if values is None:
+            return None
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def categories(self, user_id):
+        """The user's categories as ``CategoryRow`` tuples, oldest first."""
+        from app.models import Category
+        return self._get(user_id, 'categories', lambda: [
+            CategoryRow(*row) for row in db.session.query(
+                Category.id, Category.name, Category.description
+            ).filter_by(user_id=user_id).order_by(Category.id)
+        ])
+
+    def invalidate(self, user_id):
+        self.backend.invalidate(user_id)
+        if has_app_context():
+            local = g.get(REQUEST_KEY)
+            if local:
+                for entry_key in [k for k in local if k[0] == user_id]:
+                    del local[entry_key]
+
+
+lookups = LookupCache()
+
+
+def _user_values(user_id):
+    from app.models import User
+    # change_seq moves with every expense write, so it is left unloaded and
+    # read from the database if anything asks for it
+    columns = [c for c in User.__table__.columns if c.key != 'change_seq']
+    row = db.session.execute(
+        db.select(*columns).where(User.id == user_id)
+    ).mappings().first()
+    return dict(row) if row is not None else None
+
+
+def _after_flush(session, flush_context):
+    from app.models import User, Category
+    pending = session.info.setdefault(PENDING_KEY, set())
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, User) and obj.id is not None:
+            pending.add(obj.id)
+        elif isinstance(obj, Category) and obj.user_id is not None:
+            pending.add(obj.user_id)
+
+
+def _after_commit(session):
+    for user_id in session.info.pop(PENDING_KEY, ()):
+        lookups.invalidate(user_id)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,154 @@
+import os
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.schema import CreateTable
+from app import db
+
+
+# db.create_all() only creates missing tables; indexes and columns added to
+# existing models are applied here so older databases pick them up on start.
+
+
+def _index_names(engine, table_name):
+    if engine.dialect.name == 'sqlite':
+        # Reflection skips expression indexes; the catalog lists them all
+        with engine.connect() as connection:
+            return set(connection.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"
+            ), {'table': table_name}).scalars())
+    return {index['name'] for index in inspect(engine).get_indexes(table_name)}
+
+
+def _create_missing_indexes(engine):
+    for table in db.metadata.sorted_tables:
+        existing = _index_names(engine, table.name)
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+
+
+def _migrate_float_amounts(engine):
+    # Expense.amount used to be a float in major units. Amounts are rounded
+    # to the configured currency's minor unit before the old column goes,
+    # then amount_minor, added nullable to hold them, becomes NOT NULL.
+    from app import money
+    from app.models import Expense
+    columns = {c['name']: c for c in inspect(engine).get_columns('expense')}
+    if 'amount' not in columns and not columns['amount_minor']['nullable']:
+        return
+    with engine.begin() as connection:
+        if 'amount' in columns:
+            currency = money.default_currency()
+            connection.execute(text(
+                'UPDATE expense SET currency = :currency, '
+                f'amount_minor = CAST(ROUND(amount * {10 ** money.exponent(currency)}) AS BIGINT)'
+            ), {'currency': currency})
+        if engine.dialect.name != 'sqlite':
+            if 'amount' in columns:
+                connection.execute(text('ALTER TABLE expense DROP COLUMN amount'))
+            connection.execute(text('ALTER TABLE expense ALTER COLUMN amount_minor SET NOT NULL'))
+            return
+        # SQLite cannot add NOT NULL to a column, so the table is copied into
+        # one built from the model; _create_missing_indexes() restores the
+        # indexes dropped with the old one
+        metadata = MetaData()
+        for table in db.metadata.sorted_tables:
+            if table is not Expense.__table__:
+                table.to_metadata(metadata)
+        rebuilt = Expense.__table__.to_metadata(metadata, name='expense_new')
+        names = ', '.join(rebuilt.columns.keys())
+        connection.execute(CreateTable(rebuilt))
+        connection.execute(text(f'INSERT INTO expense_new ({names}) SELECT {names} FROM expense'))
+        connection.execute(text('DROP TABLE expense'))
+        connection.execute(text('ALTER TABLE expense_new RENAME TO expense'))
+
+
+def _recreate_stale_rollups(engine):
+    # The rollups are derived data, so a table from an older layout (float
+    # totals, no currency in the key, a non-unique bucket index that let
+    # concurrent writers duplicate buckets) is recreated empty and rebuilt
+    from app.models import MonthlyRollup
+    table = MonthlyRollup.__table__
+    inspector = inspect(engine)
+    if not inspector.has_table(table.name):
+        return
+    if {c['name'] for c in inspector.get_columns(table.name)} != set(table.columns.keys()) or \
+            'ix_monthly_rollup_bucket' in _index_names(engine, table.name):
+        table.drop(engine)
+        table.create(engine)
+
+
+def _backfill_rollups(engine):
+    from app.models import Expense, MonthlyRollup
+    from app import rollups
+    if db.session.query(MonthlyRollup.id).first() is None and \
+            db.session.query(Expense.id).first() is not None:
+        rollups.rebuild()
+
+
+def _backfill_change_seq(engine):
+    # Rows written before the change feed get their id as sequence, which
+    # is unique per user, and each user's counter continues above them
+    from app.models import User, Expense
+    if db.session.query(Expense.id).filter(Expense.change_seq == 0).first() is None:
+        return
+    db.session.query(Expense).filter(Expense.change_seq == 0).update(
+        {Expense.change_seq: Expense.id}, synchronize_session=False
+    )
+    latest = db.func.coalesce(db.session.query(db.func.max(Expense.change_seq)).filter(
+        Expense.user_id == User.id
+    ).scalar_subquery(), 0)
+    db.session.query(User).update(
+        {User.change_seq: db.case((User.change_seq > latest, User.change_seq), else_=latest)},
+        synchronize_session=False
+    )
+    db.session.commit()
+
+
+def _load_exchange_rates(engine):
+    from flask import current_app
+    from app.models import ExchangeRate
+    from app import rates
+    path = current_app.config['EXCHANGE_RATES_FILE']
+    if db.session.query(ExchangeRate.id).first() is None and os.path.exists(path):
+        rates.load_file(path)
+
+
+def _setup_search(engine):
+    from app import search
+    search.setup(engine)
+
+
+def _add_missing_columns(engine):
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                # Existing rows need a value, so NOT NULL is only kept
+                # when the column declares a server default to fill them
+                ddl = f'{preparer.format_column(column)} {column.type.compile(dialect=engine.dialect)}'
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    default = default.text if hasattr(default, 'text') else repr(default)
+                    ddl += f' DEFAULT {default}'
+                    if not column.nullable:
+                        ddl += ' NOT NULL'
+                connection.execute(text(
+                    f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}'
+                ))
+
+
+def upgrade(engine):
+    _recreate_stale_rollups(engine)
+    _add_missing_columns(engine)
+    _migrate_float_amounts(engine)
+    _create_missing_indexes(engine)
+    _backfill_rollups(engine)
+    _backfill_change_seq(engine)
+    _load_exchange_rates(engine)
+    _setup_search(engine)
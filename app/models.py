@@ -1,7 +1,9 @@
+import json
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from app import db
+from sqlalchemy import func, literal_column
+from sqlalchemy.orm import joinedload, selectinload, validates
+from app import db, money
 
 
 class User(UserMixin, db.Model):
@@ -10,14 +12,19 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False, index=True)
     password_hash = db.Column(db.String(256))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Last change sequence handed out to this user's expenses, see app.changes
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
     expenses = db.relationship('Expense', backref='user', lazy='dynamic', cascade='all, delete-orphan')
     categories = db.relationship('Category', backref='user', lazy='dynamic', cascade='all, delete-orphan')
 
+    # Both go through the bounded hashing pool and may raise HasherBusy
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        from app.passwords import hasher
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        from app.passwords import hasher
+        return hasher.verify(self.password_hash, password)
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -27,50 +34,273 @@ class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
     description = db.Column(db.String(256))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     expenses = db.relationship('Expense', backref='category', lazy='dynamic')
 
     def __repr__(self):
         return f'<Category {self.name}>'
 
+    @staticmethod
+    def expense_counts(user_id):
+        # One grouped query instead of a COUNT per category
+        rows = db.session.query(
+            Expense.category_id, func.count(Expense.id)
+        ).filter(
+            Expense.user_id == user_id,
+            Expense.category_id.isnot(None)
+        ).group_by(Expense.category_id).all()
+        return dict(rows)
+
 
 class Expense(db.Model):
+    # Every per-user query filters on user_id and ranges/sorts on date, so the
+    # composite indexes lead with user_id; category_id is indexed on its own
+    # for the foreign key lookups done when a category is deleted.
+    __table_args__ = (
+        db.Index('ix_expense_user_date', 'user_id', 'date'),
+        db.Index('ix_expense_user_category_date', 'user_id', 'category_id', 'date'),
+        db.Index('ix_expense_user_change_seq', 'user_id', 'change_seq'),
+        db.Index('ix_expense_user_currency_date', 'user_id', 'currency', 'date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    # Exact integer amount in the currency's minor unit (cents for USD)
+    amount_minor = db.Column(db.BigInteger, nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default=money.default_currency, server_default='USD')
     date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     description = db.Column(db.Text)
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    attachments = db.relationship('Attachment', backref='expense', lazy='dynamic', cascade='all, delete-orphan')
+    # Per-user sequence of the last write, for /api/v1/changes; 0 for rows
+    # written before the change feed existed
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    # Set by app.anomalies when the expense is created: the earlier expense
+    # it likely repeats, and how many standard deviations its amount lies
+    # above its category's mean when that is unusually high. No foreign key,
+    # so the flag outlives the original being deleted.
+    duplicate_of_id = db.Column(db.Integer)
+    outlier_score = db.Column(db.Float)
+    attachments = db.relationship('Attachment', backref='expense', cascade='all, delete-orphan')
 
     def __repr__(self):
         return f'<Expense {self.title}>'
 
+    @property
+    def amount(self):
+        """The amount in major units, as an exact ``Decimal``."""
+        return money.to_major(self.amount_minor, self.currency)
+
+    @amount.setter
+    def amount(self, value):
+        self.amount_minor = money.to_minor(value, self.currency)
+
+    @property
+    def flags(self):
+        return [name for name, value in (
+            ('duplicate', self.duplicate_of_id), ('outlier', self.outlier_score)
+        ) if value is not None]
+
+    @validates('currency')
+    def _validate_currency(self, key, currency):
+        # Keep the major-unit amount when the minor unit changes size
+        currency = money.normalize_currency(currency)
+        old = self.currency or money.default_currency()
+        if self.amount_minor is not None and money.exponent(old) != money.exponent(currency):
+            self.amount_minor = money.to_minor(money.to_major(self.amount_minor, old), currency)
+        return currency
+
+    @staticmethod
+    def eager_options():
+        # Load everything to_dict() and the list templates touch up front,
+        # so serializing a page costs a fixed number of queries.
+        return (joinedload(Expense.category), selectinload(Expense.attachments))
+
     def to_dict(self):
         return {
             'id': self.id,
             'title': self.title,
-            'amount': self.amount,
+            'amount': float(self.amount),
+            'amount_minor': self.amount_minor,
+            'currency': self.currency,
             'date': self.date.isoformat(),
             'description': self.description,
             'category': self.category.name if self.category else None,
             'category_id': self.category_id,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat(),
+            'change_seq': self.change_seq,
+            'flags': self.flags,
+            'duplicate_of': self.duplicate_of_id,
+            'outlier_score': self.outlier_score,
             'attachments': [{'id': a.id, 'filename': a.filename} for a in self.attachments]
         }
 
 
+class Tombstone(db.Model):
+    # Record of a deleted expense, so the change feed can report it
+    __table_args__ = (
+        db.Index('ix_tombstone_user_change_seq', 'user_id', 'change_seq'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    expense_id = db.Column(db.Integer, nullable=False)
+    change_seq = db.Column(db.BigInteger, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Tombstone {self.expense_id} seq={self.change_seq}>'
+
+    def to_dict(self):
+        return {
+            'id': self.expense_id,
+            'deleted': True,
+            'deleted_at': self.deleted_at.isoformat(),
+            'change_seq': self.change_seq
+        }
+
+
+class Blob(db.Model):
+    # One stored file per distinct content; ref_count is the number of
+    # Attachments pointing at it, maintained by app.storage
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Blob {self.sha256[:12]} refs={self.ref_count}>'
+
+
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(256), nullable=False)
     filepath = db.Column(db.String(512), nullable=False)
-    expense_id = db.Column(db.Integer, db.ForeignKey('expense.id'), nullable=False)
+    # NULL for files saved before the content-addressed store
+    sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256'), index=True)
+    size = db.Column(db.BigInteger)
+    expense_id = db.Column(db.Integer, db.ForeignKey('expense.id'), nullable=False, index=True)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
         return f'<Attachment {self.filename}>'
+
+
+class SearchTerm(db.Model):
+    # Inverted index used by app.search on databases without SQLite FTS5:
+    # one row per distinct word of an expense, weighted by where it occurs
+    __table_args__ = (
+        db.Index('ix_search_term_user_term', 'user_id', 'term'),
+    )
+
+    expense_id = db.Column(db.Integer, db.ForeignKey('expense.id', ondelete='CASCADE'), primary_key=True)
+    term = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    weight = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<SearchTerm {self.term} {self.expense_id}>'
+
+
+class SearchDocument(db.Model):
+    # Folded words of an expense's title and description, one field per
+    # line, for app.search to check phrases against alongside SearchTerm
+    expense_id = db.Column(db.Integer, db.ForeignKey('expense.id', ondelete='CASCADE'), primary_key=True)
+    body = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f'<SearchDocument {self.expense_id}>'
+
+
+class MonthlyRollup(db.Model):
+    # Per-user, per-category, per-currency, per-month aggregates of Expense,
+    # kept current by app.rollups on every flush; category_id is NULL for
+    # uncategorized. One row per bucket, enforced by uq_monthly_rollup_bucket.
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='CASCADE'))
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    # No server default: rows from before currencies were tracked are
+    # filled in by the migration
+    currency = db.Column(db.String(3), nullable=False)
+    # Minor units of currency, like Expense.amount_minor
+    total_minor = db.Column(db.BigInteger, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    min_minor = db.Column(db.BigInteger)
+    max_minor = db.Column(db.BigInteger)
+
+    def __repr__(self):
+        return f'<MonthlyRollup {self.user_id} {self.year}-{self.month:02d} {self.category_id} {self.currency}>'
+
+
+# The bucket key. NULLs never collide in a unique constraint, so the
+# uncategorized bucket is keyed as category 0 (ids start at 1).
+MONTHLY_ROLLUP_BUCKET = (
+    MonthlyRollup.user_id, MonthlyRollup.year, MonthlyRollup.month,
+    func.coalesce(MonthlyRollup.category_id, literal_column('0')), MonthlyRollup.currency,
+)
+db.Index('uq_monthly_rollup_bucket', *MONTHLY_ROLLUP_BUCKET, unique=True)
+
+
+class ExchangeRate(db.Model):
+    # Units of currency per one unit of EXCHANGE_RATE_BASE on a day, loaded
+    # from a file by app.rates; a day without a row uses the latest before it
+    __table_args__ = (
+        db.UniqueConstraint('currency', 'date', name='uq_exchange_rate_currency_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(3), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    rate = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<ExchangeRate {self.currency} {self.date} {self.rate}>'
+
+
+class Job(db.Model):
+    # Background work run by app.jobs; persisted so queued jobs survive a
+    # restart and clients can poll /api/v1/jobs for status and artifacts
+    __table_args__ = (
+        db.Index('ix_job_status_created', 'status', 'created_at'),
+        db.Index('ix_job_user_created', 'user_id', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))
+    kind = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    payload = db.Column(db.Text)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    artifact_path = db.Column(db.String(512))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    # Refreshed while the job runs; a running job whose heartbeat stops
+    # belonged to a process that died
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'has_artifact': self.artifact_path is not None,
+            'attempts': self.attempts,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
@@ -0,0 +1,68 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from flask import current_app, has_app_context
+
+# ISO 4217 minor-unit exponents that differ from the usual 2
+EXPONENTS = {
+    'BIF': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'ISK': 0, 'JPY': 0, 'KMF': 0, 'KRW': 0,
+    'PYG': 0, 'RWF': 0, 'UGX': 0, 'UYI': 0, 'VND': 0, 'VUV': 0, 'XAF': 0, 'XOF': 0,
+    'XPF': 0, 'BHD': 3, 'IQD': 3, 'JOD': 3, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'TND': 3,
+    'CLF': 4, 'UYW': 4,
+}
+SYMBOLS = {'USD': '$', 'EUR': '€', 'GBP': '£', 'JPY': '¥', 'INR': '₹'}
+# Largest amount a BigInteger column holds
+MAX_MINOR = 2 ** 63 - 1
+
+
+def default_currency():
+    return current_app.config['CURRENCY'] if has_app_context() else 'USD'
+
+
+def normalize_currency(code):
+    code = (code or '').strip().upper()
+    if len(code) != 3 or not code.isalpha():
+        raise ValueError(f'Invalid currency code {code!r}')
+    return code
+
+
+def exponent(currency=None):
+    return EXPONENTS.get(currency or default_currency(), 2)
+
+
+def parse_amount(value):
+    """Exact ``Decimal`` for a number or numeric string."""
+    if isinstance(value, Decimal):
+        amount = value
+    else:
+        try:
+            amount = Decimal(str(value).strip())
+        except InvalidOperation:
+            raise ValueError(f'Invalid amount {value!r}') from None
+    if not amount.is_finite():
+        raise ValueError('amount must be a finite number')
+    return amount
+
+
+def to_minor(value, currency=None):
+    """Convert a major-unit amount to integer minor units, rounding half up."""
+    scaled = parse_amount(value).scaleb(exponent(currency))
+    if abs(scaled) > MAX_MINOR:
+        raise ValueError('amount is out of range')
+    return int(scaled.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_major(minor, currency=None):
+    """Exact ``Decimal`` for an integer minor-unit amount."""
+    if minor is None:
+        return None
+    return Decimal(minor).scaleb(-exponent(currency))
+
+
+def format_money(minor, currency=None):
+    currency = currency or default_currency()
+    text = f'{to_major(minor or 0, currency):.{exponent(currency)}f}'
+    symbol = SYMBOLS.get(currency)
+    return f'{symbol}{text}' if symbol else f'{text} {currency}'
+
+
+def init_app(app):
+    app.jinja_env.filters['money'] = format_money
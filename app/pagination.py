@@ -0,0 +1,53 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+from app.models import Expense
+
+MAX_PER_PAGE = 1000
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(expense):
+    payload = json.dumps([expense.date.isoformat(), expense.id]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        date, id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return datetime.fromisoformat(date), int(id)
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+def keyset_paginate(query, cursor=None, per_page=20, with_total=False):
+    """Page ``query`` newest first by ``(date, id)`` without OFFSET.
+
+    Raises ``ValueError`` if ``cursor`` is not one produced by this module.
+    """
+    per_page = max(1, min(per_page, MAX_PER_PAGE))
+    total = query.order_by(None).count() if with_total else None
+
+    if cursor:
+        date, id = decode_cursor(cursor)
+        query = query.filter(or_(
+            Expense.date < date,
+            and_(Expense.date == date, Expense.id < id)
+        ))
+
+    rows = query.order_by(Expense.date.desc(), Expense.id.desc()).limit(per_page + 1).all()
+    items = rows[:per_page]
+    next_cursor = encode_cursor(items[-1]) if len(rows) > per_page else None
+    return KeysetPage(items, next_cursor, total)
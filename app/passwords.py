@@ -0,0 +1,149 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from collections import Counter
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+# Upper bounds of the hash duration histogram, in seconds
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing pool is full or too slow to answer in time."""
+
+
+def canonical_method(method):
+    """Spell out Werkzeug's default parameters, so a method can be compared
+    with the prefix of a stored hash."""
+    name, _, params = method.partition(':')
+    if name == 'scrypt':
+        return method if params else 'scrypt:32768:8:1'
+    if name == 'pbkdf2':
+        parts = params.split(':') if params else []
+        digest = parts[0] if parts else 'sha256'
+        iterations = parts[1] if len(parts) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{digest}:{iterations}'
+    return method
+
+
+class PasswordHasher:
+    """Runs the password KDF on a small bounded thread pool.
+
+    Werkzeug's KDFs release the GIL, so at most PASSWORD_HASH_WORKERS cores
+    go to hashing however many logins arrive at once; callers past the
+    PASSWORD_HASH_QUEUE backlog, or waiting longer than
+    PASSWORD_HASH_TIMEOUT, get HasherBusy instead of tying up a worker.
+    """
+
+    def __init__(self):
+        self.method = canonical_method('scrypt')
+        self.timeout = None
+        self.executor = None
+        self.slots = None
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.seconds = Counter()
+        self.buckets = Counter()
+        self.wait_seconds = 0.0
+        self.rejected = 0
+        self.rehashed = 0
+
+    def init_app(self, app):
+        self.method = canonical_method(app.config['PASSWORD_HASH_METHOD'])
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        if workers:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+            self.slots = threading.BoundedSemaphore(workers + app.config['PASSWORD_HASH_QUEUE'])
+        else:
+            self.executor = self.slots = None
+
+    def _observe(self, operation, seconds, waited=0.0):
+        with self.lock:
+            self.counts[operation] += 1
+            self.seconds[operation] += seconds
+            for bound in DURATION_BUCKETS:
+                if seconds <= bound:
+                    self.buckets[(operation, bound)] += 1
+            self.wait_seconds += waited
+
+    def _timed(self, operation, func, args, submitted):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self._observe(operation, time.perf_counter() - start, start - submitted)
+
+    def _run(self, operation, func, *args):
+        if self.executor is None:
+            return self._timed(operation, func, args, time.perf_counter())
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise HasherBusy
+        future = self.executor.submit(self._timed, operation, func, args, time.perf_counter())
+        future.add_done_callback(lambda f: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.rejected += 1
+            raise HasherBusy from None
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run('verify', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True for hashes made with another method or other cost parameters."""
+        return bool(pwhash) and pwhash.split('$', 1)[0] != self.method
+
+    def record_rehash(self):
+        with self.lock:
+            self.rehashed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'method': self.method,
+                'operations': dict(self.counts),
+                'seconds': dict(self.seconds),
+                'wait_seconds': self.wait_seconds,
+                'rejected': self.rejected,
+                'rehashed': self.rehashed,
+            }
+
+    def render_metrics(self):
+        """Prometheus text for instrumentation's /metrics."""
+        lines = [
+            '# HELP password_hash_duration_seconds Time spent in the password KDF.',
+            '# TYPE password_hash_duration_seconds histogram',
+        ]
+        with self.lock:
+            for operation in sorted(self.counts):
+                for bound in DURATION_BUCKETS:
+                    lines.append(f'password_hash_duration_seconds_bucket{{operation="{operation}",le="{bound}"}} '
+                                 f'{self.buckets[(operation, bound)]}')
+                lines.append(f'password_hash_duration_seconds_bucket{{operation="{operation}",le="+Inf"}} '
+                             f'{self.counts[operation]}')
+                lines.append(f'password_hash_duration_seconds_sum{{operation="{operation}"}} {self.seconds[operation]:.6f}')
+                lines.append(f'password_hash_duration_seconds_count{{operation="{operation}"}} {self.counts[operation]}')
+            for name, help, value in (
+                ('password_hash_wait_seconds_total', 'Time hashes spent queued for a worker.', f'{self.wait_seconds:.6f}'),
+                ('password_hash_rejected_total', 'Hashes refused because the pool was busy.', self.rejected),
+                ('password_rehashes_total', 'Stored hashes upgraded on login.', self.rehashed),
+            ):
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+from app.models import Expense
+
+
+def filter_expenses(query, category_id=None, start_date=None, end_date=None):
+    """Apply the optional category and ``YYYY-MM-DD`` date filters.
+
+    Unparseable dates are ignored; ``end_date`` is inclusive.
+    """
+    if category_id:
+        query = query.filter(Expense.category_id == category_id)
+    
+    if start_date:
+        try:
+            start = datetime.strptime(start_date, '%Y-%m-%d')
+            query = query.filter(Expense.date >= start)
+        except ValueError:
+            pass
+    
+    if end_date:
+        try:
+            end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+            query = query.filter(Expense.date < end)
+        except ValueError:
+            pass
+    
+    return query
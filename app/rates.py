@@ -0,0 +1,184 @@
+import csv
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from datetime import date, datetime
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, insert, update, bindparam
+from app import db, money
+from app.models import ExchangeRate
+
+# Rows written per statement when loading a rate file
+LOAD_BATCH_SIZE = 5000
+
+exchange_rate = ExchangeRate.__table__
+
+rates_cli = AppGroup('rates', help='Maintain the exchange rate table.')
+
+
+class Converter:
+    """Converts minor amounts into ``base`` for one report or export.
+
+    Factors are memoised per currency and day, so a pass over many rows does
+    one bisect per distinct day. Amounts that cannot be converted, for want
+    of a rate for their currency or for ``base``, are skipped and their
+    currency listed in ``missing``.
+    """
+
+    def __init__(self, rates, base):
+        self.rates = rates
+        self.base = base
+        self.factors = {}
+        self.missing = set()
+
+    @property
+    def version(self):
+        return self.rates.version
+
+    def factor(self, currency, day):
+        key = (currency, day)
+        if key not in self.factors:
+            to_rate = self.rates.rate(self.base, day)
+            from_rate = self.rates.rate(currency, day)
+            if to_rate is None or from_rate is None:
+                self.missing.add(currency)
+                self.factors[key] = None
+            else:
+                self.factors[key] = to_rate / from_rate * 10 ** (money.exponent(self.base) - money.exponent(currency))
+        return self.factors[key]
+
+    def convert(self, minor, currency, day):
+        """``minor`` in ``base`` minor units on ``day``, or None without a rate."""
+        if currency == self.base:
+            return minor
+        factor = self.factor(currency, day.date() if isinstance(day, datetime) else day)
+        return None if factor is None else round(minor * factor)
+
+
+class RateCache:
+    """Every exchange rate in memory as per-currency arrays sorted by date,
+    so a lookup is a bisect instead of a query.
+
+    The table is checked for changes at most every EXCHANGE_RATE_CACHE_TTL
+    seconds; a load in this process refreshes it immediately.
+    """
+
+    def __init__(self):
+        self.base = 'EUR'
+        self.ttl = 300
+        self.series = {}
+        self.version = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.base = app.config['EXCHANGE_RATE_BASE']
+        self.ttl = app.config['EXCHANGE_RATE_CACHE_TTL']
+        self.series = {}
+        self.version = self.checked_at = None
+        app.cli.add_command(rates_cli)
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.checked_at is not None and now - self.checked_at < self.ttl:
+                return
+            # Loads insert or update rows, which moves one of these
+            version = tuple(db.session.query(
+                func.count(ExchangeRate.id), func.max(ExchangeRate.id), func.sum(ExchangeRate.rate)
+            ).one())
+            if version != self.version:
+                series = {}
+                rows = db.session.query(
+                    ExchangeRate.currency, ExchangeRate.date, ExchangeRate.rate
+                ).order_by(ExchangeRate.currency, ExchangeRate.date)
+                for currency, day, rate in rows:
+                    dates, values = series.setdefault(currency, (array('l'), array('d')))
+                    dates.append(day.toordinal())
+                    values.append(rate)
+                self.series = series
+                self.version = version
+            self.checked_at = now
+
+    def rate(self, currency, day):
+        """Units of ``currency`` per unit of the base currency on ``day``:
+        the latest rate on or before it, or the earliest known rate for days
+        before the table starts."""
+        if currency == self.base:
+            return 1.0
+        series = self.series.get(currency)
+        if series is None:
+            return None
+        dates, values = series
+        return values[max(bisect_right(dates, day.toordinal()) - 1, 0)]
+
+    def currencies(self):
+        return sorted(set(self.series) | {self.base})
+
+    def converter(self, base=None):
+        self.refresh()
+        return Converter(self, base or money.default_currency())
+
+
+cache = RateCache()
+
+
+def _parse_row(row):
+    currency = money.normalize_currency(row.get('currency'))
+    day = date.fromisoformat((row.get('date') or '').strip())
+    rate = float(row.get('rate') or '')
+    if not math.isfinite(rate) or rate <= 0:
+        raise ValueError(f'Invalid rate {row.get("rate")!r}')
+    return currency, day, rate
+
+
+def load(stream):
+    """Insert or update rates from CSV text with ``date,currency,rate``
+    columns; returns ``(loaded, skipped)``."""
+    existing = {
+        (currency, day): id for id, currency, day in
+        db.session.query(ExchangeRate.id, ExchangeRate.currency, ExchangeRate.date)
+    }
+    inserts, updates, skipped = {}, {}, 0
+    for row in csv.DictReader(stream):
+        try:
+            currency, day, rate = _parse_row(row)
+        except ValueError:
+            skipped += 1
+            continue
+        # A later row for the same day wins
+        id = existing.get((currency, day))
+        if id is None:
+            inserts[(currency, day)] = {'currency': currency, 'date': day, 'rate': rate}
+        else:
+            updates[id] = {'row_id': id, 'new_rate': rate}
+    inserts, updates = list(inserts.values()), list(updates.values())
+    for start in range(0, len(inserts), LOAD_BATCH_SIZE):
+        db.session.execute(insert(exchange_rate), inserts[start:start + LOAD_BATCH_SIZE])
+    if updates:
+        db.session.execute(
+            update(exchange_rate).where(exchange_rate.c.id == bindparam('row_id'))
+            .values(rate=bindparam('new_rate')),
+            updates
+        )
+    db.session.commit()
+    cache.refresh(force=True)
+    return len(inserts) + len(updates), skipped
+
+
+def load_file(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return load(f)
+
+
+@rates_cli.command('load')
+@click.argument('path', required=False)
+def load_command(path):
+    """Load exchange rates from a CSV file (default: EXCHANGE_RATES_FILE)."""
+    from flask import current_app
+    path = path or current_app.config['EXCHANGE_RATES_FILE']
+    loaded, skipped = load_file(path)
+    click.echo(f'Loaded {loaded} rates from {path}; skipped {skipped} invalid rows.')
@@ -0,0 +1,124 @@
+import functools
+import gzip
+import hashlib
+import zlib
+from flask import request, current_app, make_response
+from flask_login import current_user
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is used without it
+    brotli = None
+
+# Bodies worth compressing; columnar exports are already zstd-compressed
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv'}
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def _base_etag(version):
+    # One representation per user, data version, path and query string
+    key = f'{current_user.id}:{version}:{request.path}?{request.query_string.decode()}'
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def _matching_tag(base):
+    # A client may hold the identity or an encoded variant; strong
+    # comparison, so weak tags never match
+    if request.if_none_match.star_tag:
+        return base
+    accepted = {base} | {f'{base}-{encoding}' for encoding in ENCODINGS}
+    for tag in request.if_none_match.as_set():
+        if tag in accepted:
+            return tag
+    return None
+
+
+def conditional(view=None, *, version=None):
+    """Serve 304 Not Modified while the user's data version is unchanged,
+    before the view runs any query.
+
+    ``version``, if given, is called for the response's other inputs (such
+    as exchange rates), which are folded into the tag.
+    """
+    if view is None:
+        return functools.partial(conditional, version=version)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        from app.changes import data_version
+        key = data_version(current_user.id)
+        if version is not None:
+            key = f'{key}:{version()}'
+        base = _base_etag(key)
+        tag = _matching_tag(base)
+        if tag is not None:
+            response = make_response('', 304)
+            response.set_etag(tag)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            response.set_etag(base)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Accept-Encoding')
+        return response
+    return wrapper
+
+
+def _compressor(encoding):
+    # (compress, flush, finish) for one stream
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(current_app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def _compress_stream(chunks, encoding):
+    compress, flush, finish = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            # Flushed per chunk so progress lines (imports) reach the client
+            # as they are generated rather than when the buffer fills
+            data = compress(chunk.encode() if isinstance(chunk, str) else chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress(response):
+    """Encode a response with the client's preferred of brotli/gzip.
+
+    Buffered bodies under COMPRESS_MIN_SIZE are left alone; streamed
+    bodies are compressed and flushed chunk by chunk as they are generated.
+    """
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or response.direct_passthrough or \
+            'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        if encoding == 'br':
+            data = brotli.compress(data, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+        else:
+            # Fixed mtime so the bytes behind a strong ETag never vary
+            data = gzip.compress(data, compresslevel=current_app.config['COMPRESS_LEVEL'], mtime=0)
+        response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    tag, weak = response.get_etag()
+    if tag:
+        response.set_etag(f'{tag}-{encoding}', weak=weak)
+    return response
@@ -0,0 +1,421 @@
+from collections import defaultdict
+from datetime import datetime
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, func, extract, select, insert, update, delete, inspect, case, or_
+from sqlalchemy.orm import Session
+from app import db, money, rates
+from app.database import UPSERT_INSERTS
+from app.models import Expense, Category, MonthlyRollup, MONTHLY_ROLLUP_BUCKET
+
+# Expense columns that decide which bucket a row falls in, plus its amount
+TRACKED_FIELDS = ('user_id', 'category_id', 'currency', 'date', 'amount_minor')
+
+# Foreign-currency rows fetched per batch while converting
+CONVERT_BATCH_SIZE = 5000
+
+rollup = MonthlyRollup.__table__
+expense = Expense.__table__
+
+rollups_cli = AppGroup('rollups', help='Maintain the monthly expense rollup table.')
+
+
+class _Delta:
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+        self.added = []
+        self.removed = []
+
+
+def _bucket(user_id, category_id, currency, date, amount_minor):
+    return (user_id, category_id, currency, date.year, date.month)
+
+
+def _month_range(year, month):
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+
+def _category_clause(column, category_id):
+    return column.is_(None) if category_id is None else column == category_id
+
+
+def _rollup_where(key):
+    user_id, category_id, currency, year, month = key
+    return (
+        rollup.c.user_id == user_id,
+        _category_clause(rollup.c.category_id, category_id),
+        rollup.c.currency == currency,
+        rollup.c.year == year,
+        rollup.c.month == month,
+    )
+
+
+def _expense_where(key):
+    user_id, category_id, currency, year, month = key
+    start, end = _month_range(year, month)
+    return (
+        expense.c.user_id == user_id,
+        _category_clause(expense.c.category_id, category_id),
+        expense.c.currency == currency,
+        expense.c.date >= start,
+        expense.c.date < end,
+    )
+
+
+def _committed(obj):
+    # Values as they were before this flush; history still holds them in
+    # after_flush, and unchanged attributes simply report their current value.
+    state = inspect(obj)
+    values = []
+    for name in TRACKED_FIELDS:
+        history = state.attrs[name].history
+        values.append(history.deleted[0] if history.deleted else getattr(obj, name))
+    return tuple(values)
+
+
+def _current(obj):
+    return tuple(getattr(obj, name) for name in TRACKED_FIELDS)
+
+
+def _add(deltas, values):
+    delta = deltas[_bucket(*values)]
+    delta.total += values[-1]
+    delta.count += 1
+    delta.added.append(values[-1])
+
+
+def _remove(deltas, values):
+    delta = deltas[_bucket(*values)]
+    delta.total -= values[-1]
+    delta.count -= 1
+    delta.removed.append(values[-1])
+
+
+def _collect(session):
+    deltas = defaultdict(_Delta)
+    for obj in session.new:
+        if isinstance(obj, Expense):
+            _add(deltas, _current(obj))
+    for obj in session.deleted:
+        if isinstance(obj, Expense):
+            _remove(deltas, _committed(obj))
+    for obj in session.dirty:
+        if isinstance(obj, Expense) and obj not in session.deleted:
+            old, new = _committed(obj), _current(obj)
+            if old != new:
+                _remove(deltas, old)
+                _add(deltas, new)
+    return deltas
+
+
+def _smaller(column, value):
+    return case((column <= value, column), else_=value)
+
+
+def _larger(column, value):
+    return case((column >= value, column), else_=value)
+
+
+def _insert_bucket(connection, key, total, count, low, high, replace=False):
+    # First write of a bucket. Where the dialect has upserts, a concurrent
+    # writer that created it meanwhile is added to (or, for a recomputed
+    # bucket, overwritten) instead of duplicated
+    user_id, category_id, currency, year, month = key
+    values = dict(
+        user_id=user_id, category_id=category_id, currency=currency, year=year, month=month,
+        total_minor=total, count=count, min_minor=low, max_minor=high
+    )
+    upsert = UPSERT_INSERTS.get(connection.dialect.name)
+    if upsert is None:
+        connection.execute(insert(rollup).values(**values))
+        return
+    statement = upsert(rollup).values(**values)
+    new = statement.excluded
+    if replace:
+        changes = {name: new[name] for name in ('total_minor', 'count', 'min_minor', 'max_minor')}
+    else:
+        changes = {
+            'total_minor': rollup.c.total_minor + new.total_minor,
+            'count': rollup.c.count + new.count,
+            'min_minor': _smaller(rollup.c.min_minor, new.min_minor),
+            'max_minor': _larger(rollup.c.max_minor, new.max_minor),
+        }
+    connection.execute(statement.on_conflict_do_update(index_elements=MONTHLY_ROLLUP_BUCKET, set_=changes))
+
+
+def _recompute(connection, key):
+    total, count, low, high = connection.execute(
+        select(
+            func.sum(expense.c.amount_minor),
+            func.count(expense.c.id),
+            func.min(expense.c.amount_minor),
+            func.max(expense.c.amount_minor)
+        ).where(*_expense_where(key))
+    ).one()
+    if count:
+        _insert_bucket(connection, key, total, count, low, high, replace=True)
+    else:
+        connection.execute(delete(rollup).where(*_rollup_where(key)))
+
+
+def _apply(connection, key, delta):
+    # One UPDATE that increments in SQL, so concurrent writers to the same
+    # bucket never overwrite each other's counts
+    values = {'total_minor': rollup.c.total_minor + delta.total, 'count': rollup.c.count + delta.count}
+    if delta.removed:
+        # A removed amount at or past an extreme may have been the extreme;
+        # re-read it through the (user_id, category_id, date) index, which
+        # already reflects the flush
+        where = _expense_where(key)
+        stale = or_(rollup.c.min_minor >= min(delta.removed), rollup.c.max_minor <= max(delta.removed))
+        low = rollup.c.min_minor if not delta.added else _smaller(rollup.c.min_minor, min(delta.added))
+        high = rollup.c.max_minor if not delta.added else _larger(rollup.c.max_minor, max(delta.added))
+        values['min_minor'] = case(
+            (stale, select(func.min(expense.c.amount_minor)).where(*where).scalar_subquery()), else_=low
+        )
+        values['max_minor'] = case(
+            (stale, select(func.max(expense.c.amount_minor)).where(*where).scalar_subquery()), else_=high
+        )
+    elif delta.added:
+        values['min_minor'] = _smaller(rollup.c.min_minor, min(delta.added))
+        values['max_minor'] = _larger(rollup.c.max_minor, max(delta.added))
+    statement = update(rollup).where(*_rollup_where(key)).values(**values)
+    if connection.dialect.update_returning:
+        row = connection.execute(statement.returning(rollup.c.id, rollup.c.count)).first()
+    else:
+        connection.execute(statement)
+        row = connection.execute(select(rollup.c.id, rollup.c.count).where(*_rollup_where(key))).first()
+
+    if row is None:
+        if delta.removed:
+            # Bucket was never built (e.g. before a backfill); derive it
+            _recompute(connection, key)
+        elif delta.added:
+            _insert_bucket(connection, key, delta.total, delta.count, min(delta.added), max(delta.added))
+    elif row.count <= 0:
+        # The count the update left, not one read before it
+        connection.execute(delete(rollup).where(rollup.c.id == row.id, rollup.c.count <= 0))
+
+
+def _apply_all(session, deltas):
+    connection = session.connection()
+    for key, delta in deltas.items():
+        _apply(connection, key, delta)
+
+
+def _after_flush(session, flush_context):
+    deltas = _collect(session)
+    if deltas:
+        _apply_all(session, deltas)
+
+
+def record_inserts(session, rows):
+    """Roll up expense rows inserted in bulk, outside the ORM unit of work.
+
+    ``rows`` are mappings with ``user_id``, ``category_id``, ``date``,
+    ``amount_minor`` and optionally ``currency``; the deltas join the
+    session's current transaction.
+    """
+    deltas = defaultdict(_Delta)
+    for row in rows:
+        values = {name: row.get(name) for name in TRACKED_FIELDS}
+        # Rows that leave currency out got the column default
+        values['currency'] = values['currency'] or money.default_currency()
+        _add(deltas, tuple(values.values()))
+    if deltas:
+        _apply_all(session, deltas)
+
+
+def _source_aggregates(user_id=None):
+    year = extract('year', expense.c.date)
+    month = extract('month', expense.c.date)
+    query = select(
+        expense.c.user_id,
+        expense.c.category_id,
+        expense.c.currency,
+        year,
+        month,
+        func.sum(expense.c.amount_minor),
+        func.count(expense.c.id),
+        func.min(expense.c.amount_minor),
+        func.max(expense.c.amount_minor)
+    ).group_by(expense.c.user_id, expense.c.category_id, expense.c.currency, year, month)
+    if user_id is not None:
+        query = query.where(expense.c.user_id == user_id)
+    return query
+
+
+def rebuild(user_id=None):
+    """Recompute rollups from the expense table; returns the row count."""
+    connection = db.session.connection()
+    clear = delete(rollup)
+    if user_id is not None:
+        clear = clear.where(rollup.c.user_id == user_id)
+    connection.execute(clear)
+    result = connection.execute(insert(rollup).from_select(
+        ['user_id', 'category_id', 'currency', 'year', 'month', 'total_minor', 'count', 'min_minor', 'max_minor'],
+        _source_aggregates(user_id)
+    ))
+    db.session.commit()
+    return result.rowcount
+
+
+def check(user_id=None):
+    """Compare rollups with the expense table.
+
+    Returns ``(key, expected, actual)`` for every bucket that differs, where
+    expected/actual are ``(total, count, min, max)`` or ``None`` if missing.
+    """
+    connection = db.session.connection()
+    expected = {}
+    for row in connection.execute(_source_aggregates(user_id)):
+        expected[(row[0], row[1], row[2], int(row[3]), int(row[4]))] = tuple(row[5:])
+
+    query = select(
+        rollup.c.user_id, rollup.c.category_id, rollup.c.currency, rollup.c.year, rollup.c.month,
+        rollup.c.total_minor, rollup.c.count, rollup.c.min_minor, rollup.c.max_minor
+    )
+    if user_id is not None:
+        query = query.where(rollup.c.user_id == user_id)
+    actual = {}
+    mismatches = []
+    for row in connection.execute(query):
+        key = tuple(row[:5])
+        if key in actual:
+            mismatches.append((key, expected.get(key), tuple(row[5:])))
+        actual[key] = tuple(row[5:])
+
+    for key in expected.keys() | actual.keys():
+        want, got = expected.get(key), actual.get(key)
+        if want != got:
+            mismatches.append((key, want, got))
+    return mismatches
+
+
+def _foreign_rows(user_id, base, year=None, month=None, category_id=None):
+    """``(date, currency, amount_minor, category_id)`` of the user's expenses
+    in currencies other than ``base``, found through the rollups and read
+    through the (user_id, currency, date) index."""
+    currencies = select(rollup.c.currency).where(
+        rollup.c.user_id == user_id, rollup.c.currency != base
+    ).distinct()
+    if year is not None:
+        currencies = currencies.where(rollup.c.year == year)
+    currencies = db.session.execute(currencies).scalars().all()
+    if not currencies:
+        return []
+    query = select(
+        expense.c.date, expense.c.currency, expense.c.amount_minor, expense.c.category_id
+    ).where(expense.c.user_id == user_id, expense.c.currency.in_(currencies))
+    if year is not None:
+        start, end = (datetime(year, 1, 1), datetime(year + 1, 1, 1)) if month is None else _month_range(year, month)
+        query = query.where(expense.c.date >= start, expense.c.date < end)
+    if category_id:
+        query = query.where(expense.c.category_id == category_id)
+    return db.session.execute(query.execution_options(yield_per=CONVERT_BATCH_SIZE))
+
+
+def _converted(rows, converter):
+    # One pass; rows without a rate are left out and noted on the converter
+    for day, currency, minor, category_id in rows:
+        value = converter.convert(minor, currency, day)
+        if value is not None:
+            yield day, category_id, value
+
+
+def _base_sum(base):
+    # Rollup buckets already in the base currency are summed in SQL
+    return func.coalesce(func.sum(case((MonthlyRollup.currency == base, MonthlyRollup.total_minor), else_=0)), 0)
+
+
+def totals(user_id, year=None, month=None, category_id=None, converter=None):
+    """Return ``(total_minor, count)`` for the user, optionally narrowed.
+
+    The total is in ``converter``'s base currency (default: CURRENCY);
+    expenses in other currencies are converted at their day's rate.
+    """
+    converter = converter or rates.cache.converter()
+    query = db.session.query(
+        _base_sum(converter.base),
+        func.coalesce(func.sum(MonthlyRollup.count), 0)
+    ).filter(MonthlyRollup.user_id == user_id)
+    if year is not None:
+        query = query.filter(MonthlyRollup.year == year)
+    if month is not None:
+        query = query.filter(MonthlyRollup.month == month)
+    if category_id:
+        query = query.filter(MonthlyRollup.category_id == category_id)
+    total, count = query.one()
+    foreign = _foreign_rows(user_id, converter.base, year, month, category_id)
+    total += sum(value for day, category, value in _converted(foreign, converter))
+    return total, count
+
+
+def monthly_totals(user_id, year, converter=None):
+    """``(month, total_minor)`` pairs for the year, in the converter's base currency."""
+    converter = converter or rates.cache.converter()
+    months = defaultdict(int, db.session.query(
+        MonthlyRollup.month, _base_sum(converter.base)
+    ).filter(
+        MonthlyRollup.user_id == user_id,
+        MonthlyRollup.year == year
+    ).group_by(MonthlyRollup.month).all())
+    for day, category, value in _converted(_foreign_rows(user_id, converter.base, year), converter):
+        months[day.month] += value
+    return sorted(months.items())
+
+
+def category_totals(user_id, year=None, converter=None):
+    """``(name, total_minor, count)`` per category, in the converter's base currency."""
+    converter = converter or rates.cache.converter()
+    query = db.session.query(
+        Category.id,
+        Category.name,
+        _base_sum(converter.base),
+        func.sum(MonthlyRollup.count)
+    ).join(MonthlyRollup, MonthlyRollup.category_id == Category.id).filter(
+        MonthlyRollup.user_id == user_id
+    )
+    if year is not None:
+        query = query.filter(MonthlyRollup.year == year)
+    rows = query.group_by(Category.id, Category.name).all()
+    sums = {id: total for id, name, total, count in rows}
+    for day, category_id, value in _converted(_foreign_rows(user_id, converter.base, year), converter):
+        if category_id in sums:
+            sums[category_id] += value
+    # Categories sharing a name are reported together
+    by_name = defaultdict(lambda: [0, 0])
+    for id, name, total, count in rows:
+        by_name[name][0] += sums[id]
+        by_name[name][1] += count
+    return [(name, total, count) for name, (total, count) in by_name.items()]
+
+
+@rollups_cli.command('rebuild')
+@click.option('--user-id', type=int, help='Only rebuild this user.')
+def rebuild_command(user_id):
+    """Backfill the rollup table from existing expenses."""
+    count = rebuild(user_id)
+    click.echo(f'Rebuilt {count} rollup rows.')
+
+
+@rollups_cli.command('check')
+@click.option('--user-id', type=int, help='Only check this user.')
+def check_command(user_id):
+    """Report buckets where the rollups disagree with the expenses."""
+    mismatches = check(user_id)
+    for key, expected, actual in mismatches:
+        click.echo(f'user={key[0]} category={key[1]} {key[2]} {key[3]}-{key[4]:02d}: '
+                   f'expected {expected}, found {actual}')
+    if mismatches:
+        raise SystemExit(1)
+    click.echo('Rollups are consistent.')
+
+
+def init_app(app):
+    if not event.contains(Session, 'after_flush', _after_flush):
+        event.listen(Session, 'after_flush', _after_flush)
+    app.cli.add_command(rollups_cli)
@@ -1,23 +1,78 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response, stream_with_context, current_app, url_for, send_file
 from flask_login import login_required, current_user
-from app.models import Expense, Category
-from datetime import datetime
+from app import money, rates
+from app.models import Expense, Category, Job
+from app.pagination import keyset_paginate
+from app.responses import conditional, compress
+from app.queries import filter_expenses
+from app.export import iter_json, iter_ndjson, iter_arrow, iter_parquet, columnar_available, COLUMNAR_FORMATS, EXPORT_JOB_FORMATS
+from datetime import date, datetime
+from sqlalchemy import or_
+import json
 
 bp = Blueprint('api', __name__, url_prefix='/api/v1')
+bp.after_request(compress)
 
 
 @bp.route('/expenses', methods=['GET'])
 @login_required
+@conditional
 def get_expenses():
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 20, type=int)
     category_id = request.args.get('category_id', type=int)
     
-    query = Expense.query.filter_by(user_id=current_user.id)
+    query = Expense.query.filter_by(user_id=current_user.id).options(*Expense.eager_options())
     
     if category_id:
         query = query.filter_by(category_id=category_id)
     
+    flagged = request.args.get('flagged')
+    if flagged == 'duplicate':
+        query = query.filter(Expense.duplicate_of_id.isnot(None))
+    elif flagged == 'outlier':
+        query = query.filter(Expense.outlier_score.isnot(None))
+    elif flagged == 'any':
+        query = query.filter(or_(Expense.duplicate_of_id.isnot(None), Expense.outlier_score.isnot(None)))
+    elif flagged is not None:
+        return jsonify({'error': 'flagged must be duplicate, outlier or any'}), 400
+    
+    # Search results are ranked by relevance, so they page by number only
+    q = request.args.get('q', '').strip()
+    if q:
+        from app import search
+        query = search.matching(query, current_user.id, q)
+        if query is None:
+            return jsonify({'error': 'q has no searchable words'}), 400
+        expenses = query.paginate(page=page, per_page=per_page, error_out=False)
+        return jsonify({
+            'expenses': [expense.to_dict() for expense in expenses.items],
+            'total': expenses.total,
+            'pages': expenses.pages,
+            'current_page': expenses.page
+        })
+    
+    # Cursor mode: pass ?cursor= (empty for the first page) to walk the
+    # history by (date, id) instead of OFFSET; the count is opt-in.
+    if 'cursor' in request.args:
+        try:
+            expenses = keyset_paginate(
+                query,
+                cursor=request.args.get('cursor'),
+                per_page=per_page,
+                with_total=request.args.get('include_total', 'false').lower() == 'true'
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        result = {
+            'expenses': [expense.to_dict() for expense in expenses.items],
+            'next_cursor': expenses.next_cursor
+        }
+        if expenses.total is not None:
+            result['total'] = expenses.total
+        return jsonify(result)
+    
     expenses = query.order_by(Expense.date.desc()).paginate(
         page=page, per_page=per_page, error_out=False
     )
@@ -33,7 +88,9 @@ def get_expenses():
 @bp.route('/expenses/<int:id>', methods=['GET'])
 @login_required
 def get_expense(id):
-    expense = Expense.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+    expense = Expense.query.filter_by(id=id, user_id=current_user.id).options(
+        *Expense.eager_options()
+    ).first_or_404()
     return jsonify(expense.to_dict())
 
 
@@ -48,9 +105,10 @@ def create_expense():
     try:
         expense = Expense(
             title=data['title'],
-            amount=float(data['amount']),
+            currency=_currency(data.get('currency')),
+            amount=money.parse_amount(data['amount']),
             date=datetime.fromisoformat(data.get('date', datetime.utcnow().isoformat())),
-            description=data.get('description'),
+            description=_description(data.get('description')),
             category_id=data.get('category_id'),
             user_id=current_user.id
         )
@@ -76,12 +134,14 @@ def update_expense(id):
     try:
         if 'title' in data:
             expense.title = data['title']
+        if 'currency' in data:
+            expense.currency = _currency(data['currency'])
         if 'amount' in data:
-            expense.amount = float(data['amount'])
+            expense.amount = money.parse_amount(data['amount'])
         if 'date' in data:
             expense.date = datetime.fromisoformat(data['date'])
         if 'description' in data:
-            expense.description = data['description']
+            expense.description = _description(data['description'])
         if 'category_id' in data:
             expense.category_id = data['category_id']
         
@@ -105,33 +165,370 @@ def delete_expense(id):
     return jsonify({'message': 'Expense deleted successfully'}), 200
 
 
+MAX_BATCH_OPERATIONS = 5000
+
+
+def _currency(code):
+    return money.default_currency() if code is None else money.normalize_currency(code)
+
+
+def _description(value):
+    if value is not None and not isinstance(value, str):
+        raise ValueError('description must be a string or null')
+    return value
+
+
+def _batch_fields(data, category_ids, partial):
+    if not isinstance(data, dict):
+        raise ValueError('data must be an object')
+    if not partial and (not data.get('title') or not data.get('amount')):
+        raise ValueError('Missing required fields')
+    
+    fields = {}
+    if 'title' in data:
+        if not isinstance(data['title'], str) or not data['title'] or len(data['title']) > 128:
+            raise ValueError('title must be a non-empty string of at most 128 characters')
+        fields['title'] = data['title']
+    if 'currency' in data or not partial:
+        fields['currency'] = _currency(data.get('currency'))
+    if 'amount' in data:
+        # Checked for range here; creates store minor units directly, while
+        # updates go through Expense.amount in the expense's currency
+        minor = money.to_minor(data['amount'], fields.get('currency'))
+        if partial:
+            fields['amount'] = money.parse_amount(data['amount'])
+        else:
+            fields['amount_minor'] = minor
+    if 'date' in data:
+        fields['date'] = datetime.fromisoformat(data['date'])
+    elif not partial:
+        fields['date'] = datetime.utcnow()
+    if 'description' in data:
+        fields['description'] = _description(data['description'])
+    if 'category_id' in data:
+        if data['category_id'] is not None and data['category_id'] not in category_ids:
+            raise ValueError(f"Unknown category_id {data['category_id']}")
+        fields['category_id'] = data['category_id']
+    return fields
+
+
+@bp.route('/expenses/batch', methods=['POST'])
+@login_required
+def batch_expenses():
+    from app import db, rollups, search, changes, anomalies
+    from app.cache import mark_stale
+    
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'operations must be a non-empty list'}), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_OPERATIONS} operations per batch'}), 413
+    atomic = bool(data.get('atomic', False))
+    
+    # Validate everything in one pass against two lookups: the user's
+    # category ids and every expense the batch updates or deletes
+    category_ids = {
+        id for (id,) in db.session.query(Category.id).filter_by(user_id=current_user.id)
+    }
+    target_ids = {
+        op.get('id') for op in operations
+        if isinstance(op, dict) and op.get('op') in ('update', 'delete') and isinstance(op.get('id'), int)
+    }
+    targets = {}
+    if target_ids:
+        targets = {
+            e.id: e for e in Expense.query.filter(
+                Expense.user_id == current_user.id, Expense.id.in_(target_ids)
+            )
+        }
+    
+    results = []
+    creates = []
+    updates = []
+    deletes = []
+    deleted_ids = set()
+    for index, op in enumerate(operations):
+        result = {'index': index}
+        results.append(result)
+        try:
+            if not isinstance(op, dict):
+                raise ValueError('operation must be an object')
+            kind = op.get('op')
+            if kind == 'create':
+                fields = _batch_fields(op.get('data'), category_ids, partial=False)
+                fields['user_id'] = current_user.id
+                creates.append((result, fields))
+            elif kind in ('update', 'delete'):
+                expense = targets.get(op.get('id'))
+                if expense is None or expense.id in deleted_ids:
+                    raise LookupError('Expense not found')
+                if kind == 'update':
+                    updates.append((result, expense, _batch_fields(op.get('data'), category_ids, partial=True)))
+                else:
+                    deleted_ids.add(expense.id)
+                    deletes.append((result, expense))
+            else:
+                raise ValueError("op must be 'create', 'update' or 'delete'")
+        except (LookupError, ValueError, TypeError) as e:
+            result.update(status='error', error=str(e))
+    
+    failed = sum(1 for r in results if r.get('status') == 'error')
+    if failed and atomic:
+        return jsonify({'results': results, 'failed': failed, 'committed': False}), 400
+    
+    for result, expense, fields in updates:
+        for name, value in fields.items():
+            setattr(expense, name, value)
+        result.update(status='updated', id=expense.id)
+    for result, expense in deletes:
+        db.session.delete(expense)
+        result.update(status='deleted', id=expense.id)
+    
+    if creates:
+        # Multi-row INSERTs instead of a flush per object; they bypass the
+        # ORM unit of work, so roll up and invalidate here
+        rows = [fields for result, fields in creates]
+        changes.insert_expenses(db.session, current_user.id, rows)
+        rollups.record_inserts(db.session, rows)
+        search.record_inserts(db.session, rows)
+        anomalies.record_inserts(db.session, rows)
+        for result, fields in creates:
+            result.update(status='created', id=fields['id'])
+            if fields['duplicate_of_id'] is not None or fields['outlier_score'] is not None:
+                result['flags'] = [name for name, key in (
+                    ('duplicate', 'duplicate_of_id'), ('outlier', 'outlier_score')
+                ) if fields[key] is not None]
+        mark_stale(db.session, current_user.id)
+    
+    db.session.commit()
+    
+    return jsonify({
+        'results': results,
+        'created': len(creates),
+        'updated': len(updates),
+        'deleted': len(deletes),
+        'failed': failed,
+        'committed': True
+    }), 207 if failed else 200
+
+
+@bp.route('/import', methods=['POST'])
+@login_required
+def import_expenses():
+    from app import importer
+    
+    file = request.files.get('file')
+    if file is None or not file.filename:
+        return jsonify({'error': 'No file provided'}), 400
+    format = request.form.get('format') or importer.detect_format(file.filename)
+    if format not in importer.FORMATS:
+        return jsonify({'error': 'Invalid format'}), 400
+    
+    # One NDJSON progress line per committed chunk; the last has done=true
+    records = importer.parse(format, file.stream)
+    progress = (
+        json.dumps(p) + '\n' for p in importer.import_expenses(current_user.id, records)
+    )
+    return Response(stream_with_context(progress), mimetype='application/x-ndjson')
+
+
+@bp.route('/changes', methods=['GET'])
+@login_required
+def get_changes():
+    from app import changes
+    
+    # The token is the last change sequence the client has applied; omit it
+    # (or pass 0) for a full sync
+    since = request.args.get('since', '0')
+    if not since.isdigit():
+        return jsonify({'error': 'Invalid since token'}), 400
+    limit = min(max(request.args.get('limit', changes.MAX_CHANGES, type=int), 1), changes.MAX_CHANGES)
+    
+    feed, last_seq, has_more = changes.feed(current_user.id, since=int(since), limit=limit)
+    return jsonify({
+        'changes': [
+            dict(change.to_dict(), deleted=False) if isinstance(change, Expense) else change.to_dict()
+            for change in feed
+        ],
+        'next_token': str(last_seq),
+        'has_more': has_more
+    })
+
+
 @bp.route('/categories', methods=['GET'])
 @login_required
+@conditional
 def get_categories():
     categories = Category.query.filter_by(user_id=current_user.id).all()
+    expense_counts = Category.expense_counts(current_user.id)
     return jsonify({
         'categories': [
             {
                 'id': c.id,
                 'name': c.name,
                 'description': c.description,
-                'expense_count': c.expenses.count()
+                'expense_count': expense_counts.get(c.id, 0)
             } for c in categories
         ]
     })
 
 
+def _export_version():
+    # The JSON total is converted at the cached exchange rates
+    if request.args.get('format', 'json') != 'json':
+        return None
+    converter = rates.cache.converter()
+    return f'{converter.base}:{converter.version}'
+
+
 @bp.route('/export', methods=['GET'])
 @login_required
+@conditional(version=_export_version)
 def export_expenses():
     format = request.args.get('format', 'json')
-    expenses = Expense.query.filter_by(user_id=current_user.id).order_by(Expense.date.desc()).all()
+    query = filter_expenses(
+        Expense.query.filter_by(user_id=current_user.id),
+        category_id=request.args.get('category_id', type=int),
+        start_date=request.args.get('start_date', type=str),
+        end_date=request.args.get('end_date', type=str)
+    )
+    
+    # background=true writes the export to a downloadable job artifact
+    if request.args.get('background', 'false').lower() == 'true':
+        if format not in EXPORT_JOB_FORMATS:
+            return jsonify({'error': 'Invalid format'}), 400
+        from app import db, jobs
+        job = jobs.enqueue('export', {
+            'format': format,
+            'category_id': request.args.get('category_id', type=int),
+            'start_date': request.args.get('start_date', type=str),
+            'end_date': request.args.get('end_date', type=str),
+            'export_folder': current_app.config['EXPORT_FOLDER']
+        }, user_id=current_user.id)
+        db.session.commit()
+        return jsonify(job.to_dict()), 202, {'Location': url_for('api.get_job', id=job.id)}
     
     if format == 'json':
-        return jsonify({
-            'expenses': [expense.to_dict() for expense in expenses],
-            'total_amount': sum(e.amount for e in expenses),
-            'count': len(expenses)
-        })
+        query = query.options(*Expense.eager_options())
+        return Response(stream_with_context(iter_json(query)), mimetype='application/json')
+    
+    if format == 'ndjson':
+        query = query.options(*Expense.eager_options())
+        return Response(stream_with_context(iter_ndjson(query)), mimetype='application/x-ndjson')
+    
+    if format in COLUMNAR_FORMATS:
+        if not columnar_available():
+            return jsonify({'error': 'Columnar export requires pyarrow'}), 501
+        mimetype, extension = COLUMNAR_FORMATS[format]
+        writer = iter_arrow if format == 'arrow' else iter_parquet
+        filename = f'expenses_{datetime.utcnow().strftime("%Y%m%d")}.{extension}'
+        return Response(
+            stream_with_context(writer(query)),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
     
     return jsonify({'error': 'Invalid format'}), 400
+
+
+def _analytics_params(args):
+    from app import analytics
+    bucket = args.get('bucket', 'month')
+    if bucket not in analytics.BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(analytics.BUCKETS)}")
+    end = date.fromisoformat(args['end']) if args.get('end') else datetime.utcnow().date()
+    # Without a start, the last 12 buckets
+    start = date.fromisoformat(args['start']) if args.get('start') else \
+        analytics.shift(analytics.bucket_start(end, bucket), bucket, -11)
+    if start > end:
+        raise ValueError('start must not be after end')
+    if analytics.bucket_count(start, end, bucket) > current_app.config['ANALYTICS_MAX_BUCKETS']:
+        raise ValueError(f"At most {current_app.config['ANALYTICS_MAX_BUCKETS']} buckets per request")
+    metrics = tuple(m for m in args.get('metrics', 'sum,count,avg').split(',') if m)
+    if not metrics or set(metrics) - set(analytics.METRICS):
+        raise ValueError(f"metrics must be drawn from {', '.join(analytics.METRICS)}")
+    percentiles = tuple(sorted({float(p) for p in args.get('percentiles', '').split(',') if p}))
+    if any(not 0 <= p <= 100 for p in percentiles):
+        raise ValueError('percentiles must be between 0 and 100')
+    window = args.get('window', type=int)
+    if window is not None and not 1 <= window <= current_app.config['ANALYTICS_MAX_BUCKETS']:
+        raise ValueError('window must be a positive number of buckets')
+    compare = args.get('compare')
+    if compare not in (None, 'yoy'):
+        raise ValueError('compare must be yoy')
+    group_by = args.get('group_by')
+    if group_by not in (None, 'category'):
+        raise ValueError('group_by must be category')
+    analytics.data_range(start, end, bucket, window, compare == 'yoy')
+    return {
+        'start': start,
+        'end': end,
+        'bucket': bucket,
+        'category_ids': tuple(sorted(set(args.getlist('category_id', type=int)))),
+        'by_category': group_by == 'category',
+        'metrics': metrics,
+        'percentiles': percentiles,
+        'window': window,
+        'compare': compare == 'yoy',
+    }
+
+
+@bp.route('/analytics', methods=['GET'])
+@login_required
+def get_analytics():
+    from app import analytics, rates
+    from app.cache import cache
+    
+    try:
+        params = _analytics_params(request.args)
+        base = _currency(request.args.get('currency'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Results are cached for the rate table (and, by the cache, the user's
+    # data version)
+    converter = rates.cache.converter(base)
+    key = f'analytics:{converter.version}:{base}:' + \
+        ':'.join(f'{name}={value}' for name, value in sorted(params.items()))
+    data = cache.get_or_set(
+        current_user.id, key,
+        lambda: analytics.aggregate(current_user.id, converter=converter, **params)
+    )
+    return jsonify(data)
+
+
+@bp.route('/jobs', methods=['GET'])
+@login_required
+def get_jobs():
+    jobs = Job.query.filter_by(user_id=current_user.id).order_by(Job.created_at.desc()).limit(50).all()
+    return jsonify({'jobs': [job.to_dict() for job in jobs]})
+
+
+@bp.route('/jobs/<int:id>', methods=['GET'])
+@login_required
+def get_job(id):
+    job = Job.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+    return jsonify(job.to_dict())
+
+
+@bp.route('/jobs/<int:id>/download', methods=['GET'])
+@login_required
+def download_job(id):
+    job = Job.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+    if job.status != 'succeeded' or not job.artifact_path:
+        return jsonify({'error': 'No artifact available', 'status': job.status}), 409
+    return send_file(
+        job.artifact_path,
+        as_attachment=True,
+        download_name=job.to_dict()['result']['filename']
+    )
+
+
+@bp.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    # Process-wide figures, so for operators rather than users
+    from app.cache import cache
+    from app.instrumentation import require_metrics_token
+    require_metrics_token()
+    return jsonify(cache.stats())
@@ -3,10 +3,19 @@ from flask_login import login_user, logout_user, current_user
 from urllib.parse import urlparse
 from app import db
 from app.models import User
+from app.passwords import hasher, HasherBusy
 from app.forms import LoginForm, RegistrationForm, ResetPasswordRequestForm, ResetPasswordForm
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+BUSY_MESSAGE = 'Too many sign-ins right now, please try again in a moment.'
+RETRY_AFTER = 5  # seconds
+
+
+def _busy(template, **context):
+    flash(BUSY_MESSAGE, 'warning')
+    return render_template(template, **context), 503, {'Retry-After': str(RETRY_AFTER)}
+
 
 @bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -16,10 +25,25 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not user.check_password(form.password.data):
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+        except HasherBusy:
+            return _busy('auth/login.html', title='Sign In', form=form)
+        if not valid:
             flash('Invalid username or password', 'danger')
             return redirect(url_for('auth.login'))
         
+        # Upgrade hashes made with an older method or cost while the
+        # plaintext is at hand; a busy pool just leaves it for next time
+        if hasher.needs_rehash(user.password_hash):
+            try:
+                user.set_password(form.password.data)
+            except HasherBusy:
+                pass
+            else:
+                db.session.commit()
+                hasher.record_rehash()
+        
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or urlparse(next_page).netloc != '':
@@ -37,7 +61,10 @@ def register():
     form = RegistrationForm()
     if form.validate_on_submit():
         user = User(username=form.username.data, email=form.email.data)
-        user.set_password(form.password.data)
+        try:
+            user.set_password(form.password.data)
+        except HasherBusy:
+            return _busy('auth/register.html', title='Register', form=form)
         db.session.add(user)
         db.session.commit()
         flash('Congratulations, you are now registered!', 'success')
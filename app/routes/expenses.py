@@ -1,22 +1,54 @@
 import os
-import csv
-from io import StringIO, BytesIO
 from datetime import datetime
-from flask import Blueprint, render_template, redirect, url_for, flash, request, send_file, current_app, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify, Response, stream_with_context, send_file, abort
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload
 from app import db
 from app.models import Expense, Category, Attachment
-from app.forms import ExpenseForm, CategoryForm
+from app.forms import ExpenseForm, CategoryForm, ImportForm
+from app import importer, storage, jobs, thumbnails, search
+from app.lookups import lookups
+from app.pagination import keyset_paginate
+from app.queries import filter_expenses
+from app.export import iter_csv, iter_ndjson, iter_arrow, iter_parquet, columnar_available, COLUMNAR_FORMATS, EXPORT_JOB_FORMATS
 
 bp = Blueprint('expenses', __name__, url_prefix='/expenses')
 
+# Attachments and their thumbnails are immutable once stored by hash
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
 
+def save_attachment(expense, file):
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    if current_app.config['JOBS_WORKERS']:
+        # Only the copy out of the request body happens here; hashing and
+        # moving into the store run on a job worker
+        return jobs.enqueue('attach_upload', {
+            'expense_id': expense.id,
+            'filename': file.filename,
+            'tmp_path': storage.stage_upload(file, upload_folder),
+            'upload_folder': upload_folder
+        }, user_id=expense.user_id)
+    
+    sha256, size, filepath = storage.save_upload(file, upload_folder)
+    attachment = Attachment(
+        filename=file.filename,
+        filepath=filepath,
+        sha256=sha256,
+        size=size,
+        expense_id=expense.id
+    )
+    db.session.add(attachment)
+    db.session.flush()
+    thumbnails.cache.schedule(attachment)
+    return attachment
+
+
 @bp.route('/')
 @login_required
 def list():
@@ -25,35 +57,39 @@ def list():
     start_date = request.args.get('start_date', type=str)
     end_date = request.args.get('end_date', type=str)
     
-    query = Expense.query.filter_by(user_id=current_user.id)
-    
-    if category_id:
-        query = query.filter_by(category_id=category_id)
+    query = Expense.query.filter_by(user_id=current_user.id).options(*Expense.eager_options())
+    query = filter_expenses(query, category_id, start_date, end_date)
     
-    if start_date:
-        try:
-            start = datetime.strptime(start_date, '%Y-%m-%d')
-            query = query.filter(Expense.date >= start)
-        except ValueError:
-            pass
+    q = request.args.get('q', '').strip()
+    searched = search.matching(query, current_user.id, q) if q else None
     
-    if end_date:
+    cursor_mode = 'cursor' in request.args and searched is None
+    next_url = None
+    if searched is not None:
+        # Ranked by relevance, so numbered pages rather than a date cursor
+        expenses = searched.paginate(page=page, per_page=10, error_out=False)
+    elif cursor_mode:
         try:
-            end = datetime.strptime(end_date, '%Y-%m-%d')
-            query = query.filter(Expense.date <= end)
+            expenses = keyset_paginate(query, cursor=request.args.get('cursor'), per_page=10)
         except ValueError:
-            pass
-    
-    expenses = query.order_by(Expense.date.desc()).paginate(
-        page=page, per_page=10, error_out=False
-    )
+            expenses = keyset_paginate(query, per_page=10)
+        if expenses.has_next:
+            args = request.args.to_dict()
+            args['cursor'] = expenses.next_cursor
+            next_url = url_for('expenses.list', **args)
+    else:
+        expenses = query.order_by(Expense.date.desc()).paginate(
+            page=page, per_page=10, error_out=False
+        )
     
-    categories = Category.query.filter_by(user_id=current_user.id).all()
+    categories = lookups.categories(current_user.id)
     
     return render_template('expenses/list.html', 
                          title='Expenses',
                          expenses=expenses,
-                         categories=categories)
+                         categories=categories,
+                         cursor_mode=cursor_mode,
+                         next_url=next_url)
 
 
 @bp.route('/create', methods=['GET', 'POST'])
@@ -61,12 +97,13 @@ def list():
 def create():
     form = ExpenseForm()
     form.category_id.choices = [(0, 'No Category')] + [
-        (c.id, c.name) for c in Category.query.filter_by(user_id=current_user.id).all()
+        (c.id, c.name) for c in lookups.categories(current_user.id)
     ]
     
     if form.validate_on_submit():
         expense = Expense(
             title=form.title.data,
+            currency=form.currency.data,
             amount=form.amount.data,
             date=form.date.data,
             description=form.description.data,
@@ -80,22 +117,14 @@ def create():
         if form.files.data:
             file = form.files.data
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                # Add timestamp to avoid conflicts
-                timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
-                filename = f"{timestamp}_{filename}"
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                
-                attachment = Attachment(
-                    filename=file.filename,
-                    filepath=filepath,
-                    expense_id=expense.id
-                )
-                db.session.add(attachment)
+                save_attachment(expense, file)
         
         db.session.commit()
         flash('Expense created successfully!', 'success')
+        if expense.duplicate_of_id is not None:
+            flash('This expense looks like a duplicate of one you already recorded.', 'warning')
+        if expense.outlier_score is not None:
+            flash('This amount is unusually high for its category.', 'warning')
         return redirect(url_for('expenses.list'))
     
     return render_template('expenses/form.html', 
@@ -110,11 +139,13 @@ def edit(id):
     expense = Expense.query.filter_by(id=id, user_id=current_user.id).first_or_404()
     form = ExpenseForm(obj=expense)
     form.category_id.choices = [(0, 'No Category')] + [
-        (c.id, c.name) for c in Category.query.filter_by(user_id=current_user.id).all()
+        (c.id, c.name) for c in lookups.categories(current_user.id)
     ]
     
     if form.validate_on_submit():
         expense.title = form.title.data
+        # The amount is converted to minor units of the new currency
+        expense.currency = form.currency.data
         expense.amount = form.amount.data
         expense.date = form.date.data
         expense.description = form.description.data
@@ -124,18 +155,7 @@ def edit(id):
         if form.files.data:
             file = form.files.data
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
-                filename = f"{timestamp}_{filename}"
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                
-                attachment = Attachment(
-                    filename=file.filename,
-                    filepath=filepath,
-                    expense_id=expense.id
-                )
-                db.session.add(attachment)
+                save_attachment(expense, file)
         
         db.session.commit()
         flash('Expense updated successfully!', 'success')
@@ -153,10 +173,11 @@ def edit(id):
 def delete(id):
     expense = Expense.query.filter_by(id=id, user_id=current_user.id).first_or_404()
     
-    # Delete associated files
-    for attachment in expense.attachments:
-        if os.path.exists(attachment.filepath):
-            os.remove(attachment.filepath)
+    # Stored blobs are unlinked by app.storage once their last reference is
+    # committed away; files saved before the store are removed by a job
+    legacy_paths = [a.filepath for a in expense.attachments if not a.sha256]
+    if legacy_paths:
+        jobs.enqueue('delete_files', {'paths': legacy_paths}, user_id=current_user.id)
     
     db.session.delete(expense)
     db.session.commit()
@@ -164,46 +185,150 @@ def delete(id):
     return redirect(url_for('expenses.list'))
 
 
+@bp.route('/attachments/<int:id>')
+@login_required
+def download_attachment(id):
+    attachment = Attachment.query.join(Expense).filter(
+        Attachment.id == id,
+        Expense.user_id == current_user.id
+    ).first_or_404()
+    if not os.path.isfile(attachment.filepath):
+        abort(404)
+    
+    # send_file hands the open file to the server's file_wrapper (sendfile
+    # where available, X-Sendfile with USE_X_SENDFILE) and answers Range,
+    # If-None-Match and If-Modified-Since itself when conditional is set
+    response = send_file(
+        attachment.filepath,
+        download_name=attachment.filename,
+        as_attachment=not request.args.get('inline'),
+        conditional=True,
+        etag=attachment.sha256 or True,
+        last_modified=attachment.uploaded_at,
+        max_age=IMMUTABLE_MAX_AGE if attachment.sha256 else 0
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if attachment.sha256:
+        # Content-addressed, so the bytes behind this id can never change
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+@bp.route('/attachments/<int:id>/thumbnail')
+@login_required
+def attachment_thumbnail(id):
+    attachment = Attachment.query.join(Expense).filter(
+        Attachment.id == id,
+        Expense.user_id == current_user.id
+    ).first_or_404()
+    if not thumbnails.previewable(attachment):
+        abort(404)
+    
+    path = thumbnails.cache.get(attachment.sha256)
+    if path is None:
+        # Evicted or not generated yet; queue it and let the page fall back
+        thumbnails.cache.schedule(attachment)
+        db.session.commit()
+        return '', 404, {'Cache-Control': 'no-store'}
+    
+    # Thumbnails are derived from immutable blobs, so they never change
+    response = send_file(path, mimetype='image/jpeg', max_age=IMMUTABLE_MAX_AGE, conditional=True)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+
 @bp.route('/export')
 @login_required
 def export():
     format = request.args.get('format', 'csv')
-    expenses = Expense.query.filter_by(user_id=current_user.id).order_by(Expense.date.desc()).all()
+    query = filter_expenses(
+        Expense.query.filter_by(user_id=current_user.id),
+        category_id=request.args.get('category', type=int),
+        start_date=request.args.get('start_date', type=str),
+        end_date=request.args.get('end_date', type=str)
+    )
+    filename = f'expenses_{datetime.utcnow().strftime("%Y%m%d")}'
+    
+    if request.args.get('background') and format in EXPORT_JOB_FORMATS:
+        job = jobs.enqueue('export', {
+            'format': format,
+            'category_id': request.args.get('category', type=int),
+            'start_date': request.args.get('start_date', type=str),
+            'end_date': request.args.get('end_date', type=str),
+            'export_folder': current_app.config['EXPORT_FOLDER']
+        }, user_id=current_user.id)
+        db.session.commit()
+        flash(f'Export #{job.id} is being prepared. Download it from '
+              f'{url_for("api.download_job", id=job.id)} once it has finished.', 'info')
+        return redirect(url_for('expenses.report'))
     
     if format == 'csv':
-        output = StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['Date', 'Title', 'Amount', 'Category', 'Description'])
-        
-        for expense in expenses:
-            writer.writerow([
-                expense.date.strftime('%Y-%m-%d'),
-                expense.title,
-                expense.amount,
-                expense.category.name if expense.category else 'N/A',
-                expense.description or ''
-            ])
-        
-        output.seek(0)
-        bytes_output = BytesIO(output.getvalue().encode('utf-8'))
-        bytes_output.seek(0)
-        return send_file(
-            bytes_output,
+        query = query.options(joinedload(Expense.category))
+        return Response(
+            stream_with_context(iter_csv(query)),
             mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'expenses_{datetime.utcnow().strftime("%Y%m%d")}.csv'
+            headers={'Content-Disposition': f'attachment; filename={filename}.csv'}
+        )
+    
+    if format == 'ndjson':
+        query = query.options(*Expense.eager_options())
+        return Response(
+            stream_with_context(iter_ndjson(query)),
+            mimetype='application/x-ndjson',
+            headers={'Content-Disposition': f'attachment; filename={filename}.ndjson'}
+        )
+    
+    if format in COLUMNAR_FORMATS:
+        if not columnar_available():
+            return jsonify({'error': 'Columnar export requires pyarrow'}), 501
+        mimetype, extension = COLUMNAR_FORMATS[format]
+        writer = iter_arrow if format == 'arrow' else iter_parquet
+        return Response(
+            stream_with_context(writer(query)),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename={filename}.{extension}'}
         )
     
     return jsonify({'error': 'Invalid format'}), 400
 
 
+@bp.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_statement():
+    form = ImportForm()
+    
+    if form.validate_on_submit():
+        file = form.file.data
+        records = importer.parse(importer.detect_format(file.filename), file.stream)
+        for progress in importer.import_expenses(current_user.id, records):
+            pass
+        
+        flash(f"Imported {progress['imported']} expenses "
+              f"({progress['skipped']} rows skipped).", 'success')
+        if progress['duplicates']:
+            flash(f"{progress['duplicates']} imported expenses look like duplicates of existing ones.", 'warning')
+        for error in progress['errors'][:5]:
+            flash(f"Line {error['line']}: {error['error']}", 'warning')
+        return redirect(url_for('expenses.list'))
+    
+    return render_template('expenses/import.html',
+                         title='Import Expenses',
+                         form=form)
+
+
 @bp.route('/categories')
 @login_required
 def categories():
-    categories = Category.query.filter_by(user_id=current_user.id).all()
+    categories = lookups.categories(current_user.id)
     return render_template('expenses/categories.html', 
                          title='Categories',
-                         categories=categories)
+                         categories=categories,
+                         expense_counts=Category.expense_counts(current_user.id))
 
 
 @bp.route('/categories/create', methods=['GET', 'POST'])
@@ -261,41 +386,36 @@ def delete_category(id):
 @bp.route('/report')
 @login_required
 def report():
-    from sqlalchemy import func, extract
-    from datetime import datetime
+    from app import rollups, rates, money
+    from app.cache import cache
     
     # Get filter parameters
     current_year = datetime.utcnow().year
     year = request.args.get('year', current_year, type=int)
+    if not 1 <= year < 9999:
+        year = current_year
     category_id = request.args.get('category', type=int)
+    try:
+        currency = money.normalize_currency(request.args.get('currency') or money.default_currency())
+    except ValueError:
+        currency = money.default_currency()
+    converter = rates.cache.converter(currency)
+    
+    # Read the monthly rollups instead of scanning the year's expenses;
+    # only expenses in other currencies than the report's are converted
+    def compute():
+        return {
+            'monthly_expenses': [tuple(r) for r in rollups.monthly_totals(current_user.id, year, converter=converter)],
+            'category_expenses': [tuple(r) for r in rollups.category_totals(current_user.id, year=year, converter=converter)],
+            'total': rollups.totals(current_user.id, year=year, category_id=category_id, converter=converter)[0],
+            'unconverted': sorted(converter.missing),
+        }
+    
+    data = cache.get_or_set(
+        current_user.id, f'report:{year}:{category_id or ""}:{currency}:{converter.version}', compute
+    )
     
-    query = Expense.query.filter_by(user_id=current_user.id)
-    query = query.filter(extract('year', Expense.date) == year)
-    
-    if category_id:
-        query = query.filter_by(category_id=category_id)
-    
-    # Monthly expenses
-    monthly_expenses = db.session.query(
-        extract('month', Expense.date).label('month'),
-        func.sum(Expense.amount).label('total')
-    ).filter(
-        Expense.user_id == current_user.id,
-        extract('year', Expense.date) == year
-    ).group_by('month').all()
-    
-    # Category breakdown
-    category_expenses = db.session.query(
-        Category.name,
-        func.sum(Expense.amount).label('total'),
-        func.count(Expense.id).label('count')
-    ).join(Expense).filter(
-        Expense.user_id == current_user.id,
-        extract('year', Expense.date) == year
-    ).group_by(Category.name).all()
-    
-    categories = Category.query.filter_by(user_id=current_user.id).all()
-    total = query.with_entities(func.sum(Expense.amount)).scalar() or 0
+    categories = lookups.categories(current_user.id)
     
     # Generate year range for the dropdown
     year_range = range(2020, current_year + 2)
@@ -303,8 +423,8 @@ def report():
     return render_template('expenses/report.html',
                          title='Expense Report',
                          year=year,
-                         monthly_expenses=monthly_expenses,
-                         category_expenses=category_expenses,
                          categories=categories,
-                         total=total,
-                         year_range=year_range)
+                         year_range=year_range,
+                         currency=currency,
+                         currencies=rates.cache.currencies(),
+                         **data)
@@ -1,6 +1,5 @@
 from flask import Blueprint, render_template, session
 from flask_login import login_required, current_user
-from app import db
 
 bp = Blueprint('main', __name__)
 
@@ -10,44 +9,67 @@ def index():
     return render_template('index.html', title='Home')
 
 
-@bp.route('/dashboard')
-@login_required
-def dashboard():
-    from app.models import Expense, Category
-    from sqlalchemy import func, extract
-    from datetime import datetime, timedelta
+def _dashboard_data(user_id, today, converter):
+    from app.models import Expense
+    from app import rollups
+    from app.lookups import lookups
+    from sqlalchemy.orm import joinedload
     
-    # Get statistics
-    total_expenses = db.session.query(func.sum(Expense.amount)).filter_by(user_id=current_user.id).scalar() or 0
-    expense_count = Expense.query.filter_by(user_id=current_user.id).count()
-    category_count = Category.query.filter_by(user_id=current_user.id).count()
+    # Aggregates come from the monthly rollups, so their cost depends on the
+    # number of months with expenses rather than the number of expenses;
+    # only expenses in other currencies are read and converted
+    total_expenses, expense_count = rollups.totals(user_id, converter=converter)
+    category_count = len(lookups.categories(user_id))
     
     # Get this month's expenses
-    today = datetime.utcnow()
-    first_day = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    this_month = db.session.query(func.sum(Expense.amount)).filter(
-        Expense.user_id == current_user.id,
-        Expense.date >= first_day
-    ).scalar() or 0
+    this_month, _ = rollups.totals(user_id, year=today.year, month=today.month, converter=converter)
     
     # Get expenses by category
-    expenses_by_category = db.session.query(
-        Category.name,
-        func.sum(Expense.amount).label('total')
-    ).join(Expense).filter(
-        Expense.user_id == current_user.id
-    ).group_by(Category.name).all()
+    expenses_by_category = [
+        (name, total) for name, total, count in rollups.category_totals(user_id, converter=converter)
+    ]
+    
+    # Get recent expenses, as plain dicts so they can be cached
+    recent_expenses = [
+        {
+            'title': e.title,
+            'date': e.date.strftime('%Y-%m-%d'),
+            'amount_minor': e.amount_minor,
+            'currency': e.currency,
+            'category': {'name': e.category.name} if e.category else None
+        }
+        for e in Expense.query.filter_by(user_id=user_id).options(
+            joinedload(Expense.category)
+        ).order_by(
+            Expense.date.desc()
+        ).limit(5)
+    ]
+    
+    return {
+        'total_expenses': total_expenses,
+        'expense_count': expense_count,
+        'category_count': category_count,
+        'this_month': this_month,
+        'expenses_by_category': expenses_by_category,
+        'recent_expenses': recent_expenses,
+        'currency': converter.base,
+        'unconverted': sorted(converter.missing),
+    }
+
+
+@bp.route('/dashboard')
+@login_required
+def dashboard():
+    from app.cache import cache
+    from app import rates
+    from datetime import datetime
     
-    # Get recent expenses
-    recent_expenses = Expense.query.filter_by(user_id=current_user.id).order_by(
-        Expense.date.desc()
-    ).limit(5).all()
+    today = datetime.utcnow()
+    converter = rates.cache.converter()
+    data = cache.get_or_set(
+        current_user.id,
+        f'dashboard:{today:%Y-%m}:{converter.base}:{converter.version}',
+        lambda: _dashboard_data(current_user.id, today, converter)
+    )
     
-    return render_template('dashboard.html', 
-                         title='Dashboard',
-                         total_expenses=total_expenses,
-                         expense_count=expense_count,
-                         category_count=category_count,
-                         this_month=this_month,
-                         expenses_by_category=expenses_by_category,
-                         recent_expenses=recent_expenses)
+    return render_template('dashboard.html', title='Dashboard', **data)
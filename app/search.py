@@ -0,0 +1,313 @@
+import re
+import unicodedata
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event, select, delete, insert, func, text, inspect, bindparam, Integer, Float
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from app import db
+from app.models import Expense, Category, SearchTerm, SearchDocument
+
+# Session.info key for expense ids whose category changed name or went away
+PENDING_KEY = 'search_reindex'
+# Longest query accepted, in terms and phrases
+MAX_QUERY_TERMS = 16
+# Ids per DELETE/INSERT ... IN (...) statement
+CHUNK_SIZE = 500
+# Field weights for ranking: a hit in the title beats one in the category,
+# which beats one in the description
+WEIGHTS = {'title': 10, 'category': 5, 'description': 2}
+# Expense attributes that feed the index
+INDEXED_FIELDS = ('user_id', 'title', 'description', 'category_id')
+
+FTS_TABLE = 'expense_fts'
+
+expense = Expense.__table__
+category = Category.__table__
+search_term = SearchTerm.__table__
+search_document = SearchDocument.__table__
+
+search_cli = AppGroup('search', help='Maintain the expense search index.')
+
+
+def _use_fts():
+    # Chosen per app by setup(): SQLite FTS5 if the database has it, else
+    # the SearchTerm table
+    return current_app.extensions.get('search') == 'fts'
+
+
+def _words(value):
+    # Same folding and splitting as FTS5's unicode61 tokenizer with
+    # remove_diacritics, which treats '_' as a separator
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    return re.findall(r'[^\W_]+', value.lower())
+
+
+def parse_query(q):
+    """Split a search string into ``('term', word, prefix)`` and
+    ``('phrase', words)`` tokens.
+
+    Double quotes make a phrase and a trailing ``*`` makes a prefix term;
+    every token must match.
+    """
+    tokens = []
+    for phrase, bare in re.findall(r'"([^"]*)"|(\S+)', q or ''):
+        if phrase:
+            words = _words(phrase)
+            if len(words) > 1:
+                tokens.append(('phrase', words))
+            elif words:
+                tokens.append(('term', words[0], False))
+            continue
+        words = _words(bare)
+        for i, word in enumerate(words):
+            prefix = bare.endswith('*') and i == len(words) - 1
+            tokens.append(('term', word, prefix))
+    return tokens[:MAX_QUERY_TERMS]
+
+
+def _fts_match(user_id, tokens):
+    parts = []
+    for token in tokens:
+        if token[0] == 'phrase':
+            parts.append('"%s"' % ' '.join(token[1]))
+        else:
+            parts.append('"%s"%s' % (token[1], '*' if token[2] else ''))
+    # The owner column holds a single u<id> token, so FTS intersects the
+    # user's posting list with the terms instead of filtering afterwards
+    return 'owner:"u%d" AND {title description category}: (%s)' % (user_id, ' AND '.join(parts))
+
+
+def _term_clause(word, prefix):
+    if prefix:
+        return (SearchTerm.term >= word, SearchTerm.term < word + '\U0010ffff')
+    return (SearchTerm.term == word,)
+
+
+def matching(query, user_id, q):
+    """Narrow an Expense query to rows matching ``q``, best matches first.
+
+    Returns ``None`` if ``q`` holds no searchable words.
+    """
+    tokens = parse_query(q)
+    if not tokens:
+        return None
+
+    if _use_fts():
+        hits = text(
+            f'SELECT rowid AS expense_id, '
+            f'bm25({FTS_TABLE}, 0, {WEIGHTS["title"]}, {WEIGHTS["description"]}, {WEIGHTS["category"]}) AS score '
+            f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match'
+        ).bindparams(match=_fts_match(user_id, tokens)).columns(
+            expense_id=Integer, score=Float
+        ).cte().prefix_with('MATERIALIZED')
+        # Materialized so SQLite runs the MATCH once and probes expense by
+        # id, rather than walking the user's expenses and matching per row
+        # (notably in paginate()'s count). bm25() is lower for better matches
+        return query.join(hits, hits.c.expense_id == Expense.id).order_by(
+            hits.c.score, Expense.date.desc(), Expense.id.desc()
+        )
+
+    score = None
+    for token in tokens:
+        words = token[1] if token[0] == 'phrase' else [token[1]]
+        for i, word in enumerate(words):
+            prefix = token[0] == 'term' and token[2]
+            hits = select(
+                SearchTerm.expense_id, func.max(SearchTerm.weight).label('weight')
+            ).where(
+                SearchTerm.user_id == user_id, *_term_clause(word, prefix)
+            ).group_by(SearchTerm.expense_id).subquery()
+            query = query.join(hits, hits.c.expense_id == Expense.id)
+            score = hits.c.weight if score is None else score + hits.c.weight
+        if token[0] == 'phrase':
+            # The index only knows the words are present; check their order
+            # in the folded text, where words are space-separated and each
+            # field sits on its own space-padded line
+            phrase = ' '.join(words).replace('\\', '\\\\').replace('_', '\\_')
+            query = query.filter(Expense.id.in_(
+                select(search_document.c.expense_id).where(
+                    search_document.c.body.like(f'% {phrase} %', escape='\\')
+                )
+            ))
+    return query.order_by(score.desc(), Expense.date.desc(), Expense.id.desc())
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def _source(ids):
+    return select(
+        expense.c.id,
+        expense.c.user_id,
+        expense.c.title,
+        func.coalesce(expense.c.description, ''),
+        func.coalesce(category.c.name, '')
+    ).select_from(
+        expense.outerjoin(category, category.c.id == expense.c.category_id)
+    ).where(expense.c.id.in_(ids))
+
+
+def _document(id, title, description):
+    return {
+        'expense_id': id,
+        'body': '\n'.join(' %s ' % ' '.join(_words(value)) for value in (title, description)),
+    }
+
+
+def _terms(id, user_id, title, description, category_name):
+    weights = {}
+    for field, value in (('title', title), ('description', description), ('category', category_name)):
+        for word in set(_words(value)):
+            word = word[:SearchTerm.term.type.length]
+            weights[word] = weights.get(word, 0) + WEIGHTS[field]
+    return [
+        {'expense_id': id, 'user_id': user_id, 'term': word, 'weight': weight}
+        for word, weight in weights.items()
+    ]
+
+
+def reindex(connection, ids):
+    """Refresh the index entries of the given expense ids from the table;
+    ids that no longer exist are dropped from it."""
+    for chunk in _chunks(ids):
+        rows = connection.execute(_source(chunk)).all()
+        if _use_fts():
+            connection.execute(text(f'DELETE FROM {FTS_TABLE} WHERE rowid IN :ids').bindparams(
+                bindparam('ids', expanding=True)
+            ), {'ids': chunk})
+            if rows:
+                connection.execute(text(
+                    f'INSERT INTO {FTS_TABLE} (rowid, owner, title, description, category) '
+                    f'VALUES (:id, :owner, :title, :description, :category)'
+                ), [
+                    {'id': id, 'owner': f'u{user_id}', 'title': title,
+                     'description': description, 'category': category_name}
+                    for id, user_id, title, description, category_name in rows
+                ])
+        else:
+            connection.execute(delete(search_term).where(search_term.c.expense_id.in_(chunk)))
+            connection.execute(delete(search_document).where(search_document.c.expense_id.in_(chunk)))
+            terms = [term for row in rows for term in _terms(*row)]
+            if terms:
+                connection.execute(insert(search_term), terms)
+            if rows:
+                connection.execute(insert(search_document), [
+                    _document(id, title, description) for id, user_id, title, description, category_name in rows
+                ])
+
+
+def _changed(obj, names):
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in names)
+
+
+def _before_flush(session, flush_context, instances):
+    # Deleting a category nulls its expenses' category_id inside the flush,
+    # where they never show up as dirty; remember them while we still can
+    category_ids = [
+        obj.id for obj in session.deleted
+        if isinstance(obj, Category) and obj.id is not None
+    ] + [
+        obj.id for obj in session.dirty
+        if isinstance(obj, Category) and obj.id is not None and _changed(obj, ('name',))
+    ]
+    if category_ids:
+        ids = session.info.setdefault(PENDING_KEY, set())
+        for chunk in _chunks(category_ids):
+            ids.update(session.connection().scalars(
+                select(expense.c.id).where(expense.c.category_id.in_(chunk))
+            ))
+
+
+def _after_flush(session, flush_context):
+    ids = session.info.pop(PENDING_KEY, set())
+    for obj in session.new:
+        if isinstance(obj, Expense):
+            ids.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Expense):
+            ids.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Expense) and _changed(obj, INDEXED_FIELDS):
+            ids.add(obj.id)
+    if ids:
+        reindex(session.connection(), ids)
+
+
+def record_inserts(session, rows):
+    """Index expense rows inserted in bulk, outside the ORM unit of work.
+
+    ``rows`` are mappings that include the new ``id``.
+    """
+    reindex(session.connection(), [row['id'] for row in rows])
+
+
+def _create_fts(engine):
+    with engine.begin() as connection:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = :name"
+        ), {'name': FTS_TABLE}).first() is not None
+        if not exists:
+            connection.execute(text(
+                f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5('
+                f"owner, title, description, category, tokenize = 'unicode61 remove_diacritics 2')"
+            ))
+    return not exists
+
+
+def setup(engine):
+    """Pick the backend for this database and build the index if it is new."""
+    current_app.extensions['search'] = 'terms'
+    created = False
+    if engine.dialect.name == 'sqlite':
+        try:
+            created = _create_fts(engine)
+            current_app.extensions['search'] = 'fts'
+        except OperationalError:
+            # SQLite built without FTS5
+            pass
+    if not _use_fts():
+        # Documents came after terms, so an index without them is rebuilt
+        created = db.session.query(SearchDocument.expense_id).first() is None
+    if created and db.session.query(Expense.id).first() is not None:
+        rebuild()
+
+
+def rebuild(user_id=None):
+    """Re-index every expense, or one user's; returns the expense count."""
+    query = select(expense.c.id).order_by(expense.c.id)
+    if user_id is not None:
+        query = query.where(expense.c.user_id == user_id)
+    connection = db.session.connection()
+    ids = connection.scalars(query).all()
+    if user_id is None:
+        if _use_fts():
+            connection.execute(text(f'DELETE FROM {FTS_TABLE}'))
+        else:
+            connection.execute(delete(search_term))
+            connection.execute(delete(search_document))
+    reindex(connection, ids)
+    db.session.commit()
+    return len(ids)
+
+
+@search_cli.command('rebuild')
+@click.option('--user-id', type=int, help='Only rebuild this user.')
+def rebuild_command(user_id):
+    """Rebuild the search index from existing expenses."""
+    count = rebuild(user_id)
+    click.echo(f'Indexed {count} expenses.')
+
+
+def init_app(app):
+    if not event.contains(Session, 'before_flush', _before_flush):
+        event.listen(Session, 'before_flush', _before_flush)
+    if not event.contains(Session, 'after_flush', _after_flush):
+        event.listen(Session, 'after_flush', _after_flush)
+    app.cli.add_command(search_cli)
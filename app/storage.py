@@ -0,0 +1,187 @@
+import hashlib
+import os
+import tempfile
+from sqlalchemy import event, inspect, select, update, insert, delete
+from sqlalchemy.orm import Session
+from app.database import UPSERT_INSERTS
+from app.models import Attachment, Blob
+
+# Bytes read from an upload between hash updates
+CHUNK_SIZE = 64 * 1024
+# Session.info key for blob files to unlink once the transaction commits
+PENDING_KEY = 'storage_unlink'
+
+blob_table = Blob.__table__
+
+
+def blob_path(upload_folder, sha256):
+    # Two levels of 256-way sharding keep directories small
+    return os.path.join(upload_folder, 'objects', sha256[:2], sha256[2:4], sha256)
+
+
+def save_upload(file, upload_folder):
+    """Store an uploaded file by content; returns ``(sha256, size, path)``.
+
+    The upload is hashed while it is copied to a temporary file in the same
+    file system, then renamed into place, so a blob is never seen partially
+    written and identical uploads share one file.
+    """
+    digest = hashlib.sha256()
+    tmp_path, size = _copy_to_temp(file.stream, upload_folder, digest)
+    return _place(tmp_path, digest.hexdigest(), size, upload_folder)
+
+
+def stage_upload(file, upload_folder):
+    """Copy an upload to a temporary file for store_staged() to finish later."""
+    tmp_path, size = _copy_to_temp(file.stream, upload_folder)
+    return tmp_path
+
+
+def hash_staged(tmp_path):
+    """``(sha256, size)`` of a staged upload."""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'rb') as staged:
+            while True:
+                chunk = staged.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+    except BaseException:
+        _discard(tmp_path)
+        raise
+    return digest.hexdigest(), size
+
+
+def store_staged(tmp_path, upload_folder, sha256=None, size=None):
+    """Move a staged upload into the store, like save_upload(), hashing it
+    first unless ``sha256`` and ``size`` are already known."""
+    if sha256 is None:
+        sha256, size = hash_staged(tmp_path)
+    return _place(tmp_path, sha256, size, upload_folder)
+
+
+def _discard(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _copy_to_temp(stream, upload_folder, digest=None):
+    tmp_dir = os.path.join(upload_folder, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if digest is not None:
+                    digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        _discard(tmp_path)
+        raise
+    return tmp_path, size
+
+
+def _place(tmp_path, sha256, size, upload_folder):
+    path = blob_path(upload_folder, sha256)
+    try:
+        # Same content, so replacing an existing blob is harmless, and it
+        # restores one a concurrent delete is about to unlink
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _discard(tmp_path)
+        raise
+    return sha256, size, path
+
+
+def _committed(obj, name):
+    history = inspect(obj).attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(obj, name)
+
+
+def _insert_blob(connection, sha256, size):
+    values = {'sha256': sha256, 'size': size, 'ref_count': 0}
+    upsert = UPSERT_INSERTS.get(connection.dialect.name)
+    if upsert is not None:
+        statement = upsert(blob_table).values(**values).on_conflict_do_nothing(index_elements=['sha256'])
+    else:
+        statement = insert(blob_table).values(**values).prefix_with('IGNORE', dialect='mysql')
+    connection.execute(statement)
+
+
+def _after_flush(session, flush_context):
+    added = {}
+    removed = {}
+    for obj in session.new:
+        if isinstance(obj, Attachment) and obj.sha256:
+            added.setdefault(obj.sha256, [0, obj.size or 0, obj.filepath])[0] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Attachment):
+            sha256 = _committed(obj, 'sha256')
+            if sha256:
+                removed.setdefault(sha256, [0, _committed(obj, 'filepath')])[0] += 1
+    if not added and not removed:
+        return
+
+    connection = session.connection()
+    for sha256, (count, size, path) in added.items():
+        _insert_blob(connection, sha256, size)
+        connection.execute(
+            update(blob_table).where(blob_table.c.sha256 == sha256)
+            .values(ref_count=blob_table.c.ref_count + count)
+        )
+        # The update holds the row, so a delete of the same content has
+        # either unlinked its file already or will now see the reference
+        if path and not os.path.exists(path):
+            raise FileNotFoundError(f'Blob {sha256} was removed while being stored; upload it again')
+    for sha256, (count, path) in removed.items():
+        connection.execute(
+            update(blob_table).where(blob_table.c.sha256 == sha256)
+            .values(ref_count=blob_table.c.ref_count - count)
+        )
+        remaining = connection.execute(
+            select(blob_table.c.ref_count).where(blob_table.c.sha256 == sha256)
+        ).scalar()
+        if remaining is not None and remaining <= 0:
+            # The row goes in _after_commit, together with the file
+            session.info.setdefault(PENDING_KEY, {})[sha256] = path
+
+
+def _after_commit(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if not pending:
+        return
+    # A concurrent upload may have referenced the content again since.
+    # Deleting the unreferenced rows first locks them (on SQLite, the whole
+    # database) until the files are gone, so an upload either lands before
+    # the check or finds the file missing when it updates the row.
+    with session.get_bind().begin() as connection:
+        connection.execute(delete(blob_table).where(
+            blob_table.c.sha256.in_(pending), blob_table.c.ref_count <= 0
+        ))
+        live = set(connection.execute(
+            select(blob_table.c.sha256).where(blob_table.c.sha256.in_(pending))
+        ).scalars())
+        for sha256, path in pending.items():
+            if sha256 not in live and path and os.path.exists(path):
+                os.remove(path)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(PENDING_KEY, None)
+
+
+def init_app(app):
+    if not event.contains(Session, 'after_flush', _after_flush):
+        event.listen(Session, 'after_flush', _after_flush)
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
@@ -0,0 +1,174 @@
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:  # optional, needed for any previews
+    Image = None
+
+try:
+    import pymupdf as fitz  # optional, needed for PDF previews
+except ImportError:
+    fitz = None
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Bounding box of a thumbnail, in pixels
+THUMBNAIL_SIZE = (240, 240)
+JPEG_QUALITY = 80
+# Seconds between full re-scans of the cache directory
+SWEEP_INTERVAL = 300
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+
+def previewable(attachment):
+    if Image is None or not attachment.sha256:
+        return False
+    ext = _extension(attachment.filename)
+    return ext in IMAGE_EXTENSIONS or (ext == 'pdf' and fitz is not None)
+
+
+def render(source_path, filename):
+    """Return JPEG bytes of a thumbnail for an image or the first PDF page."""
+    if _extension(filename) == 'pdf':
+        with fitz.open(source_path, filetype='pdf') as document:
+            page = document.load_page(0)
+            # Render at roughly the thumbnail size instead of full resolution
+            zoom = max(THUMBNAIL_SIZE) / max(page.rect.width, page.rect.height, 1)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    else:
+        image = Image.open(source_path)
+        # Lets JPEG decoding skip straight to a reduced scale
+        image.draft('RGB', THUMBNAIL_SIZE)
+    image.thumbnail(THUMBNAIL_SIZE)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Size-bounded directory of thumbnails keyed by blob hash, evicting the
+    least recently served first.
+
+    Recency is kept in memory and mirrored to file mtimes, so the order
+    survives a restart when the directory is re-scanned. The directory is
+    shared by every worker process; each keeps a running total of its own
+    puts and re-scans periodically to pick up the others' and hold the limit.
+    Queued and failed renders are tracked through thumbnail jobs, which every
+    process sees.
+    """
+
+    def __init__(self):
+        self.folder = None
+        self.max_bytes = 0
+        self.entries = None
+        self.total = 0
+        self.scanned_at = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.folder = app.config['THUMBNAIL_FOLDER']
+        self.max_bytes = app.config['THUMBNAIL_CACHE_BYTES']
+        self.entries = None
+        app.jinja_env.globals['has_preview'] = previewable
+
+    def schedule(self, attachment):
+        """Queue a thumbnail job unless one is cached, queued or has failed."""
+        from app import db, jobs
+        from app.models import Job
+        if not previewable(attachment) or os.path.exists(self.path(attachment.sha256)):
+            return
+        # A failed job is not retried until it expires (JOBS_RETENTION)
+        if db.session.query(Job.query.filter(
+            Job.kind == 'thumbnail',
+            Job.status.in_(('queued', 'running', 'failed')),
+            Job.payload.contains(f'"sha256": "{attachment.sha256}"'),
+        ).exists()).scalar():
+            return
+        jobs.enqueue(
+            'thumbnail', {'attachment_id': attachment.id, 'sha256': attachment.sha256},
+            user_id=attachment.expense.user_id
+        )
+
+    def generate(self, attachment):
+        if self.get(attachment.sha256) is None:
+            self.put(attachment.sha256, render(attachment.filepath, attachment.filename))
+
+    def path(self, sha256):
+        return os.path.join(self.folder, sha256[:2], f'{sha256}.jpg')
+
+    def _load(self, rescan=False):
+        # Called with the lock held
+        if self.entries is not None and not rescan:
+            return
+        found = []
+        if os.path.isdir(self.folder):
+            for root, dirs, files in os.walk(self.folder):
+                for name in files:
+                    if name.endswith('.jpg'):
+                        stat = os.stat(os.path.join(root, name))
+                        found.append((stat.st_mtime, name[:-4], stat.st_size))
+        found.sort()
+        self.entries = OrderedDict((sha256, size) for mtime, sha256, size in found)
+        self.total = sum(self.entries.values())
+        self.scanned_at = time.monotonic()
+
+    def get(self, sha256):
+        """Path of the cached thumbnail, or None; marks it recently used."""
+        # The file, not the index, decides: another process may have
+        # written or evicted it
+        path = self.path(sha256)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            with self.lock:
+                if self.entries is not None:
+                    self.total -= self.entries.pop(sha256, 0)
+            return None
+        # The mtime only orders the next re-scan, so it needs no finer
+        # resolution than the re-scan interval
+        if time.time() - stat.st_mtime > SWEEP_INTERVAL:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self._load()
+            self.total += stat.st_size - self.entries.pop(sha256, 0)
+            self.entries[sha256] = stat.st_size
+        return path
+
+    def put(self, sha256, data):
+        path = self.path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.part'
+        with open(tmp_path, 'wb') as out:
+            out.write(data)
+        os.replace(tmp_path, path)
+
+        evicted = []
+        with self.lock:
+            self._load(rescan=time.monotonic() - self.scanned_at >= SWEEP_INTERVAL)
+            self.total += len(data) - self.entries.pop(sha256, 0)
+            self.entries[sha256] = len(data)
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
+                self.total -= size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except FileNotFoundError:
+                pass
+        return path
+
+
+cache = ThumbnailCache()
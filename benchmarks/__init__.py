@@ -0,0 +1,4 @@
+"""Benchmark suite: synthetic data generator and endpoint timings.
+
+Run ``python -m benchmarks --help`` for usage.
+"""
@@ -0,0 +1,159 @@
+"""Command line entry point: ``python -m benchmarks run|compare``."""
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from config import Config
+from app import create_app
+from app.models import User, Expense
+from benchmarks import data, runner
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _make_app(args, workdir):
+    database = args.database or f'sqlite:///{os.path.join(workdir, "benchmark.db")}'
+    config = type('BenchmarkConfig', (Config,), {
+        'SQLALCHEMY_DATABASE_URI': database,
+        'WTF_CSRF_ENABLED': False,
+        'JOBS_WORKERS': 0,
+        'CACHE_BACKEND': args.cache_backend,
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'EXPORT_FOLDER': os.path.join(workdir, 'exports'),
+        'THUMBNAIL_FOLDER': os.path.join(workdir, 'thumbnails'),
+    })
+    return create_app(config)
+
+
+def _log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='expense-benchmark-')
+    app = _make_app(args, workdir)
+
+    seed_seconds = None
+    with app.app_context():
+        user = User.query.filter_by(username='bench0').first()
+        if user is None:
+            _log(f'Seeding {args.rows} expenses for {args.users} users in {workdir}')
+            start = time.perf_counter()
+            data.seed(
+                args.rows, users=args.users, categories=args.categories,
+                attachment_ratio=args.attachment_ratio, upload_folder=app.config['UPLOAD_FOLDER'],
+                random_seed=args.seed, progress=lambda n: _log(f'  {n} rows')
+            )
+            seed_seconds = time.perf_counter() - start
+            user = User.query.filter_by(username='bench0').one()
+        else:
+            _log(f'Reusing seeded database in {workdir}')
+        total_rows = Expense.query.count()
+        users = User.query.count()
+        rows = user.expenses.count()
+        params = {
+            'year': datetime.utcnow().year,
+            'last_page': max(1, math.ceil(rows / 10)),
+            # Ask for roughly the last hundred changes
+            'token': max(0, user.change_seq - 100),
+        }
+
+    def progress(name, result):
+        latency = result['latency_ms']
+        _log(f'{name:22} p50 {latency["p50"]:9.2f} ms  p90 {latency["p90"]:9.2f} ms  '
+             f'{result["queries"]:4} queries  {result["peak_memory_bytes"] / 1024:9.0f} KiB')
+
+    results = runner.run(
+        app, 'bench0', iterations=args.iterations, scenarios=args.scenario,
+        params=params, progress=progress
+    )
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+            'cache_backend': args.cache_backend,
+            'rows': total_rows,
+            'users': users,
+            'user_rows': rows,
+            'iterations': args.iterations,
+            'seed_seconds': seed_seconds,
+            # ru_maxrss is KiB on Linux
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        },
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+        _log(f'Wrote {args.output}')
+    else:
+        print(output)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = runner.compare(baseline, current, threshold=args.threshold)
+    for name, metric, before, after in regressions:
+        print(f'{name}: {metric} {before:.2f} -> {after:.2f} (+{(after / before - 1) * 100 if before else math.inf:.0f}%)')
+    if regressions:
+        sys.exit(1)
+    print('No regressions.')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Seed a database and time the endpoints.')
+    run_parser.add_argument('--rows', type=int, default=10000, help='Expenses to generate (1k to 10M).')
+    run_parser.add_argument('--users', type=int, default=10, help='Users to spread the rows over.')
+    run_parser.add_argument('--categories', type=int, default=8, help='Categories per user.')
+    run_parser.add_argument('--attachment-ratio', type=float, default=0.05,
+                            help='Share of expenses with an attachment.')
+    run_parser.add_argument('--seed', type=int, default=0, help='Random seed for the generator.')
+    run_parser.add_argument('--iterations', type=int, default=20, help='Timed requests per scenario.')
+    run_parser.add_argument('--scenario', action='append', choices=sorted(runner.SCENARIOS),
+                            help='Only run this scenario (repeatable).')
+    run_parser.add_argument('--database', help='Database URL (default: SQLite in the work directory).')
+    run_parser.add_argument('--workdir', help='Directory for the database and files; '
+                                              'an existing seeded one is reused.')
+    run_parser.add_argument('--cache-backend', default='null',
+                            help='Result cache backend; null (default) measures uncached work.')
+    run_parser.add_argument('--output', help='Write the JSON report here instead of stdout.')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='Compare two JSON reports.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help='Fractional slowdown reported as a regression (default: 0.2).')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
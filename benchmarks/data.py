@@ -0,0 +1,150 @@
+"""Synthetic data for the benchmarks.
+
+Rows go in through the same bulk insert the importer uses, then the derived
+tables (rollups, search index, blob reference counts) are rebuilt once,
+which is far faster than maintaining them per chunk at millions of rows.
+"""
+import io
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import insert, update, func
+from werkzeug.datastructures import FileStorage
+from app import db, rollups, search, storage, changes
+from app.models import User, Category, Attachment, Blob
+
+PASSWORD = 'benchmark'
+CHUNK_SIZE = 10000
+
+VENDORS = [
+    'Acme Corp', 'Globex', 'Initech', 'Umbrella', 'Stark Industries', 'Wayne Enterprises',
+    'Hooli', 'Vandelay Industries', 'Soylent', 'Cyberdyne', 'Staples', 'Amazon', 'Uber',
+    'Lyft', 'Delta', 'United', 'Marriott', 'Hilton', 'Starbucks', 'FedEx', 'UPS', 'Dell',
+    'Adobe', 'Zoom', 'Slack', 'GitHub', 'AWS', 'Shell', 'Chevron', 'Office Depot',
+]
+ITEMS = [
+    'lunch', 'dinner', 'coffee', 'flight', 'hotel', 'taxi', 'parking', 'fuel', 'supplies',
+    'subscription', 'license', 'hardware', 'shipping', 'conference', 'training', 'printing',
+]
+CATEGORIES = [
+    'Travel', 'Meals', 'Office Supplies', 'Software', 'Hardware', 'Shipping', 'Fuel',
+    'Lodging', 'Training', 'Marketing', 'Utilities', 'Rent', 'Insurance', 'Legal',
+]
+WORDS = ITEMS + ['client', 'team', 'quarterly', 'review', 'project', 'onsite', 'remote', 'q1', 'q2']
+
+
+def _users(count):
+    users = []
+    for n in range(count):
+        user = User(username=f'bench{n}', email=f'bench{n}@example.com')
+        user.set_password(PASSWORD)
+        users.append(user)
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def _categories(rng, user_ids, per_user):
+    rows = [
+        {'user_id': user_id, 'name': name, 'description': f'{name} expenses'}
+        for user_id in user_ids
+        for name in rng.sample(CATEGORIES, min(per_user, len(CATEGORIES)))
+    ]
+    ids = db.session.scalars(
+        insert(Category).returning(Category.id, sort_by_parameter_order=True), rows
+    ).all()
+    db.session.commit()
+    by_user = {}
+    for row, id in zip(rows, ids):
+        by_user.setdefault(row['user_id'], []).append(id)
+    return by_user
+
+
+def _expense_rows(rng, user_ids, category_ids, rows, years):
+    end = datetime.utcnow()
+    span = int(timedelta(days=365 * years).total_seconds())
+    for n in range(rows):
+        user_id = user_ids[n % len(user_ids)]
+        categories = category_ids.get(user_id)
+        yield {
+            'user_id': user_id,
+            'title': f'{rng.choice(VENDORS)} {rng.choice(ITEMS)}',
+            'amount_minor': min(round(rng.lognormvariate(3.5, 1.1) * 100), 5000000),
+            'date': end - timedelta(seconds=rng.randrange(span)),
+            'description': ' '.join(rng.sample(WORDS, 4)) if rng.random() < 0.6 else None,
+            # About one in ten expenses is left uncategorized
+            'category_id': rng.choice(categories) if categories and rng.random() < 0.9 else None,
+        }
+
+
+def _blobs(rng, count, upload_folder):
+    blobs = []
+    for n in range(count):
+        data = rng.randbytes(rng.randrange(2048, 65536))
+        sha256, size, path = storage.save_upload(FileStorage(io.BytesIO(data)), upload_folder)
+        blobs.append((sha256, size, path))
+    db.session.execute(insert(Blob), [
+        {'sha256': sha256, 'size': size, 'ref_count': 0} for sha256, size, path in blobs
+    ])
+    return blobs
+
+
+def seed(rows, users=10, categories=8, attachment_ratio=0.05, blobs=200, years=3,
+         upload_folder=None, random_seed=0, progress=None):
+    """Fill the current app's database with synthetic data.
+
+    ``rows`` expenses are spread evenly over ``users``; about
+    ``attachment_ratio`` of them get an attachment drawn from ``blobs``
+    distinct files. Returns the seeded user ids.
+    """
+    rng = random.Random(random_seed)
+    user_ids = _users(users)
+    category_ids = _categories(rng, user_ids, categories)
+    stored = _blobs(rng, blobs, upload_folder) if upload_folder and attachment_ratio else []
+
+    chunk = []
+    inserted = 0
+    for row in _expense_rows(rng, user_ids, category_ids, rows, years):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            inserted += _insert_chunk(rng, chunk, stored, attachment_ratio)
+            chunk = []
+            if progress:
+                progress(inserted)
+    if chunk:
+        inserted += _insert_chunk(rng, chunk, stored, attachment_ratio)
+        if progress:
+            progress(inserted)
+
+    if stored:
+        counts = db.session.query(
+            Attachment.sha256, func.count(Attachment.id)
+        ).group_by(Attachment.sha256).all()
+        for sha256, count in counts:
+            db.session.execute(update(Blob).where(Blob.sha256 == sha256).values(ref_count=count))
+    db.session.commit()
+
+    rollups.rebuild()
+    search.rebuild()
+    return user_ids
+
+
+def _insert_chunk(rng, rows, stored, attachment_ratio):
+    by_user = {}
+    for row in rows:
+        by_user.setdefault(row['user_id'], []).append(row)
+    for user_id, user_rows in by_user.items():
+        changes.insert_expenses(db.session, user_id, user_rows)
+    ids = [row['id'] for row in rows]
+    if stored:
+        attachments = []
+        for id in ids:
+            if rng.random() < attachment_ratio:
+                sha256, size, path = rng.choice(stored)
+                attachments.append({
+                    'expense_id': id, 'filename': f'receipt_{id}.pdf', 'filepath': path,
+                    'sha256': sha256, 'size': size
+                })
+        if attachments:
+            db.session.execute(insert(Attachment), attachments)
+    db.session.commit()
+    return len(ids)
@@ -0,0 +1,143 @@
+"""Drive the app's pages and API through the Flask test client and measure
+latency, SQL statement counts and peak Python memory per scenario."""
+import gc
+import statistics
+import time
+import tracemalloc
+from sqlalchemy import event
+from app import db
+from benchmarks.data import PASSWORD
+
+# name -> (method, url); URLs may use {year}, {last_page} and {token}
+SCENARIOS = {
+    'list': ('GET', '/expenses/'),
+    'list_deep_page': ('GET', '/expenses/?page={last_page}'),
+    'list_cursor': ('GET', '/expenses/?cursor='),
+    'list_search': ('GET', '/expenses/?q=acme+lunch'),
+    'dashboard': ('GET', '/dashboard'),
+    'report': ('GET', '/expenses/report?year={year}'),
+    'export_csv': ('GET', '/expenses/export?format=csv'),
+    'api_expenses': ('GET', '/api/v1/expenses'),
+    'api_expenses_cursor': ('GET', '/api/v1/expenses?cursor=&per_page=100'),
+    'api_expenses_search': ('GET', '/api/v1/expenses?q=hotel'),
+    'api_categories': ('GET', '/api/v1/categories'),
+    'api_changes': ('GET', '/api/v1/changes?since={token}'),
+    'api_export_json': ('GET', '/api/v1/export?format=json'),
+    'api_export_ndjson': ('GET', '/api/v1/export?format=ndjson'),
+    'api_analytics': ('GET', '/api/v1/analytics?bucket=week&start={year}-01-01&end={year}-12-31'
+                              '&group_by=category&percentiles=50,90&window=4&compare=yoy'),
+}
+
+# Absolute differences below these are noise rather than regressions
+NOISE_FLOOR = {'p50_ms': 1.0, 'p90_ms': 2.0, 'queries': 0, 'peak_memory_bytes': 64 * 1024}
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _request(client, method, url):
+    # Read the whole body, so streamed responses are timed end to end
+    response = client.open(url, method=method)
+    size = sum(len(chunk) for chunk in response.response)
+    response.close()
+    return response.status_code, size
+
+
+def login(client, username):
+    response = client.post('/auth/login', data={'username': username, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'Could not log in as {username}')
+
+
+def run_scenario(engine, client, method, url, iterations, warmup=1):
+    for _ in range(warmup):
+        _request(client, method, url)
+
+    timings = []
+    queries = []
+    status = size = None
+    for _ in range(iterations):
+        with QueryCounter(engine) as counter:
+            start = time.perf_counter()
+            status, size = _request(client, method, url)
+            timings.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.count)
+
+    # A separate pass for memory, since tracing slows everything down
+    gc.collect()
+    tracemalloc.start()
+    _request(client, method, url)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'url': url,
+        'status': status,
+        'response_bytes': size,
+        'iterations': iterations,
+        'latency_ms': {
+            'min': min(timings),
+            'p50': _percentile(timings, 0.50),
+            'p90': _percentile(timings, 0.90),
+            'p99': _percentile(timings, 0.99),
+            'max': max(timings),
+            'mean': statistics.fmean(timings),
+        },
+        'queries': max(queries),
+        'peak_memory_bytes': peak,
+    }
+
+
+def run(app, username, iterations=20, scenarios=None, params=None, progress=None):
+    """Run the named scenarios (default: all) as ``username``."""
+    with app.app_context():
+        engine = db.engine
+    # No app context is held open here, so each request gets a fresh
+    # session just as it would behind a real server
+    client = app.test_client()
+    login(client, username)
+    results = {}
+    for name in scenarios or SCENARIOS:
+        method, url = SCENARIOS[name]
+        results[name] = run_scenario(engine, client, method, url.format(**(params or {})), iterations)
+        if progress:
+            progress(name, results[name])
+    return results
+
+
+def compare(baseline, current, threshold=0.2):
+    """Return ``(scenario, metric, before, after)`` for every metric that got
+    worse by more than ``threshold`` (a fraction) between two result files."""
+    regressions = []
+    for name, after in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        for metric, old, new in (
+            ('p50_ms', before['latency_ms']['p50'], after['latency_ms']['p50']),
+            ('p90_ms', before['latency_ms']['p90'], after['latency_ms']['p90']),
+            ('queries', before['queries'], after['queries']),
+            ('peak_memory_bytes', before['peak_memory_bytes'], after['peak_memory_bytes']),
+        ):
+            if new > old * (1 + threshold) and new - old > NOISE_FLOOR[metric]:
+                regressions.append((name, metric, old, new))
+    return regressions
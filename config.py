@@ -9,7 +9,76 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'expenses.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection pool; SQLALCHEMY_ENGINE_OPTIONS, if set, overrides these
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 10)
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 20)
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 1800)
+    # SQLite pragmas applied to every new connection
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL'
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -65536)  # negative = KiB
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)  # ms
     UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'txt', 'doc', 'docx', 'xls', 'xlsx'}
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
+    # Background jobs (uploads, file deletes, exports); 0 workers runs them
+    # inline right after the request's commit
+    JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS') or 2)
+    # A running job's process refreshes its heartbeat every interval; one
+    # silent for JOBS_STALE_AFTER is retried by the next process to start
+    JOBS_HEARTBEAT_INTERVAL = int(os.environ.get('JOBS_HEARTBEAT_INTERVAL') or 30)  # seconds
+    JOBS_STALE_AFTER = int(os.environ.get('JOBS_STALE_AFTER') or 300)  # seconds
+    # Finished jobs, and the export files they produced, are deleted after this
+    JOBS_RETENTION = int(os.environ.get('JOBS_RETENTION') or 7 * 24 * 3600)  # seconds
+    EXPORT_FOLDER = os.path.join(basedir, 'exports')
+    # Let a fronting server (nginx X-Accel, Apache mod_xsendfile) send attachment files
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+    # API response compression (brotli when the brotli package is installed)
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 1024)
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY') or 5)
+    # Attachment previews; least recently served are evicted past the limit
+    THUMBNAIL_FOLDER = os.path.join(basedir, 'thumbnails')
+    THUMBNAIL_CACHE_BYTES = int(os.environ.get('THUMBNAIL_CACHE_BYTES') or 256 * 1024 * 1024)
+    # Opt-in request instrumentation: Server-Timing headers, /metrics,
+    # slow query and N+1 logging, and sampled cProfile dumps
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS') or 100)
+    N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD') or 20)
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)  # fraction of requests
+    PROFILE_FOLDER = os.path.join(basedir, 'profiles')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # bearer token for /metrics; unset serves it only in debug
+    # Currency of new expenses; amounts are stored in its minor unit
+    CURRENCY = (os.environ.get('CURRENCY') or 'USD').upper()
+    # Exchange rates are stored as units per EXCHANGE_RATE_BASE and loaded
+    # from EXCHANGE_RATES_FILE (date,currency,rate) by `flask rates load`
+    EXCHANGE_RATE_BASE = (os.environ.get('EXCHANGE_RATE_BASE') or 'EUR').upper()
+    EXCHANGE_RATES_FILE = os.environ.get('EXCHANGE_RATES_FILE') or os.path.join(basedir, 'exchange_rates.csv')
+    EXCHANGE_RATE_CACHE_TTL = int(os.environ.get('EXCHANGE_RATE_CACHE_TTL') or 300)  # seconds
+    # Password KDF (a Werkzeug method string) and the pool that runs it;
+    # logins past the queue, or waiting longer than the timeout, get a 503
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)  # 0 hashes inline
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 32)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 10)  # seconds
+    # Dashboard/report result cache: 'memory', 'shared' or 'null'.
+    # 'shared' uses Redis at CACHE_URL, or an in-process stand-in if unset.
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND') or 'memory'
+    CACHE_URL = os.environ.get('CACHE_URL')
+    CACHE_TTL = int(os.environ.get('CACHE_TTL') or 300)
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES') or 1024)
+    # New expenses with the same amount, currency and title within this many
+    # days of another are flagged as likely duplicates; amounts this many
+    # standard deviations above their category's mean as outliers, once the
+    # category has enough expenses to judge
+    DUPLICATE_WINDOW_DAYS = int(os.environ.get('DUPLICATE_WINDOW_DAYS') or 3)
+    OUTLIER_ZSCORE = float(os.environ.get('OUTLIER_ZSCORE') or 3.0)
+    OUTLIER_MIN_SAMPLES = int(os.environ.get('OUTLIER_MIN_SAMPLES') or 20)
+    # Longest series /api/v1/analytics returns per group
+    ANALYTICS_MAX_BUCKETS = int(os.environ.get('ANALYTICS_MAX_BUCKETS') or 3660)
+    # Current user and category list, kept per process across requests;
+    # other workers see category edits once the TTL runs out
+    LOOKUP_CACHE_TTL = int(os.environ.get('LOOKUP_CACHE_TTL') or 30)
+    LOOKUP_CACHE_MAX_ENTRIES = int(os.environ.get('LOOKUP_CACHE_MAX_ENTRIES') or 4096)
@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import Attachment, Category, Expense, User
+from config import Config
+
+SIZES = (5, 20)
+
+
+@pytest.fixture
+def client_for(tmp_path):
+    """A logged-in test client over a user with ``n`` expenses, each in its
+    own category and with one attachment."""
+
+    def make(n):
+        class TestConfig(Config):
+            TESTING = True
+            SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / f'{n}.db'}"
+            UPLOAD_FOLDER = str(tmp_path / 'uploads')
+            EXCHANGE_RATES_FILE = str(tmp_path / 'missing.csv')
+            WTF_CSRF_ENABLED = False
+            JOBS_WORKERS = 0
+            CACHE_BACKEND = 'null'
+            PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+            PASSWORD_HASH_WORKERS = 0
+
+        app = create_app(TestConfig)
+        with app.app_context():
+            user = User(username='alice', email='alice@example.com')
+            user.set_password('secret123')
+            db.session.add(user)
+            db.session.flush()
+            for i in range(n):
+                category = Category(name=f'Category {i}', user_id=user.id)
+                expense = Expense(title=f'Expense {i}', user_id=user.id, category=category,
+                                  date=datetime(2026, 1, i % 28 + 1))
+                expense.amount = '12.34'
+                db.session.add(expense)
+                db.session.flush()
+                receipt = tmp_path / f'{n}-receipt{i}.txt'
+                receipt.write_text(str(i))
+                db.session.add(Attachment(
+                    filename=receipt.name, filepath=str(receipt), sha256=f'{n:032x}{i:032x}', size=1,
+                    expense_id=expense.id
+                ))
+            db.session.commit()
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'alice', 'password': 'secret123'})
+        return app, client
+
+    return make
+
+
+def count_statements(app, client, url):
+    # The first request warms the per-process caches; count the second
+    client.get(url)
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get(url)
+        response.get_data()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize('url', [
+    '/api/v1/expenses?per_page={n}',
+    '/api/v1/export',
+    '/api/v1/export?format=ndjson',
+    '/api/v1/categories',
+    '/expenses/',
+])
+def test_statement_count_does_not_grow_with_rows(client_for, url):
+    counts = [count_statements(*client_for(n), url.format(n=n)) for n in SIZES]
+    assert counts[0] == counts[1]